@@ -0,0 +1,183 @@
+''' How much CPU we may actually use, how busy it is, and a concurrency limit that adjusts to that.
+
+    Counting /proc/cpuinfo processors says how many the machine has,
+    which in a container or under taskset can be a lot more than we are allowed to use.
+'''
+import os
+import math
+import time
+import threading
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def cgroup_cpu_limit():
+    ''' The CPU quota of our cgroup, in CPUs (may be fractional), or None if there is none (or we can't tell).
+        Looks at cgroup v2 (cpu.max) and v1 (cpu.cfs_quota_us / cpu.cfs_period_us)
+    '''
+    # which cgroup we are in, per hierarchy. v2 is the line starting with 0::
+    paths = {}
+    for line in (_read('/proc/self/cgroup') or '').splitlines():
+        parts = line.split(':', 2)
+        if len(parts) == 3:
+            for controller in (parts[1].split(',') if parts[1] else ['']):
+                paths[controller] = parts[2]
+
+    if '' in paths: # v2
+        cpumax = _read( os.path.join('/sys/fs/cgroup', paths[''].lstrip('/'), 'cpu.max') )  or  _read('/sys/fs/cgroup/cpu.max')
+        if cpumax:
+            quota, period = (cpumax.split() + ['100000'])[:2]
+            if quota != 'max':
+                return float(quota) / float(period)
+            return None
+
+    for base in ('/sys/fs/cgroup/cpu,cpuacct', '/sys/fs/cgroup/cpu'): # v1
+        for sub in (paths.get('cpu','').lstrip('/'), ''):  # inside a container we tend to see our own cgroup as the root
+            quota  = _read( os.path.join(base, sub, 'cpu.cfs_quota_us') )
+            period = _read( os.path.join(base, sub, 'cpu.cfs_period_us') )
+            if quota is not None and period is not None:
+                if int(quota) > 0:
+                    return float(quota) / float(period)
+                return None
+    return None
+
+
+def cpu_count(fallback=2):
+    ''' How many CPUs we may use: the smallest of
+        - the CPUs in our affinity mask (taskset, cpusets)
+        - the cgroup CPU quota, rounded up (docker --cpus, kubernetes limits)
+        - what the machine has
+    '''
+    counts = []
+    if hasattr(os, 'sched_getaffinity'):
+        counts.append( len(os.sched_getaffinity(0)) )
+    else:
+        counts.append( os.cpu_count() or fallback )
+    quota = cgroup_cpu_limit()
+    if quota is not None:
+        counts.append( max(1, int(math.ceil(quota))) )
+    return max(1, min(counts))
+
+
+class LoadSampler(object):
+    ''' Each sample() returns (busy, iowait) as fractions, averaged since the previous call.
+        busy is relative to the CPUs we may use (cpu_count()), and comes from our cgroup's own usage when that is readable (cgroup v2),
+        otherwise from /proc/stat (system-wide).  iowait always comes from /proc/stat.
+    '''
+    def __init__(self, ncpus=None):
+        if ncpus is None:
+            ncpus = cpu_count()
+        self.ncpus = ncpus
+        self.cgroup_stat = None
+        for line in (_read('/proc/self/cgroup') or '').splitlines():
+            if line.startswith('0::'):
+                path = os.path.join('/sys/fs/cgroup', line[3:].lstrip('/'), 'cpu.stat')
+                if _read(path) is not None:
+                    self.cgroup_stat = path
+        self.last = self._now()
+
+    def _now(self):
+        ' (wall time, cgroup usage seconds or None, /proc/stat busy jiffies, iowait jiffies, total jiffies) '
+        usage = None
+        if self.cgroup_stat is not None:
+            for line in (_read(self.cgroup_stat) or '').splitlines():
+                if line.startswith('usage_usec '):
+                    usage = int(line.split()[1]) / 1e6
+        busy, iowait, total = 0, 0, 1
+        for line in (_read('/proc/stat') or '').splitlines():
+            if line.startswith('cpu '):
+                vals = list( int(v)   for v in line.split()[1:] )
+                # user nice system idle iowait irq softirq steal (guest is already counted in user)
+                idle, iowait = vals[3], vals[4]
+                total = sum(vals[:8])
+                busy  = total - idle - iowait
+                break
+        return time.time(), usage, busy, iowait, total
+
+    def sample(self):
+        now = self._now()
+        (t0, u0, b0, w0, j0), (t1, u1, b1, w1, j1) = self.last, now
+        self.last = now
+        jiffies = max(1, j1 - j0)
+        iowait  = float(w1 - w0) / jiffies
+        if u0 is not None and u1 is not None and t1 > t0:
+            busy = (u1 - u0) / ((t1 - t0) * self.ncpus)
+        else:
+            busy = float(b1 - b0) / jiffies
+        return min(1., busy), iowait
+
+
+class AdaptiveLimit(object):
+    ''' A counting semaphore (acquire/release) whose limit can be changed while in use,
+        and optionally tunes itself (start_tuning) from how busy the CPUs are:
+        - if there is idle CPU, little iowait, and we are using all our slots, allow one more
+        - if iowait is high (we are waiting on disk/network more than computing, so more jobs would only thrash), allow one fewer
+        - if CPU is saturated while we run more jobs than CPUs, allow one fewer (more jobs would just timeshare)
+    '''
+    def __init__(self, limit, minimum=1, maximum=None):
+        self.limit   = limit
+        self.minimum = minimum
+        self.maximum = maximum or limit
+        self.active  = 0
+        self.cond    = threading.Condition()
+        self.peak    = 0     # most active since the last tune
+        self.stopped = False
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def set_limit(self, limit):
+        with self.cond:
+            self.limit = max(self.minimum, min(self.maximum, limit))
+            self.cond.notify_all()
+
+    def tune(self, busy, iowait, ncpus):
+        ''' one adjustment step given a LoadSampler sample, see class docstring. Returns the new limit '''
+        with self.cond:
+            saturated = self.peak >= self.limit
+            self.peak = self.active
+        if iowait > 0.25:
+            self.set_limit( self.limit - 1 )
+        elif busy > 0.95 and self.limit > ncpus:
+            self.set_limit( self.limit - 1 )
+        elif busy < 0.85 and iowait < 0.10 and saturated:
+            self.set_limit( self.limit + 1 )
+        return self.limit
+
+    def start_tuning(self, interval=5., sampler=None, report=None):
+        ''' Starts a background thread that calls tune() every interval seconds.
+            report, if given, is called with (limit, busy, iowait) when the limit changes.
+        '''
+        if sampler is None:
+            sampler = LoadSampler()
+
+        def tuner():
+            while not self.stopped:
+                time.sleep(interval)
+                busy, iowait = sampler.sample()
+                before = self.limit
+                after  = self.tune(busy, iowait, sampler.ncpus)
+                if after != before and report is not None:
+                    report(after, busy, iowait)
+
+        thread = threading.Thread(target=tuner, name='adaptivelimit')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.stopped = True
@@ -3,31 +3,43 @@
     so that we don't have to deal with binary linking with the ffmpeg libraries (or similar).
 
     In the current use 
-    - we ask ffmpeg for 16-bit mono,
+    - we ask ffmpeg for mono, as 16-bit integers or 32-bit floats (see SAMPLE_FORMATS),
     - and return chunk_samples-sized float32 numpy arrays at a time.
 
     
     I wanted this to be a generator so that large files could be streamed. 
-    It turns out that decode failure (from stdout _and_ stderr) is messy,
-    and an easy workaround was to have a thread for each. It may be possible to simplify that.
+    It turns out that decode failure (from stdout _and_ stderr) is messy.
+    This used to be a thread for each, it is now one selectors loop in the generator itself.
+
+    open_decoder() picks between that and in-process libraries (PyAV, soundfile) when they are installed,
+    which saves the two processes per file. WAV (and raw PCM) is memory-mapped and read directly.
 
     TODO:
     - detect ffmpeg/ffprobe ahead of time rather than just assuming they're there, fail out with proper error message
       - detect avconv as well as ffmpeg
-    - rethink the thready details, it may mean the process may not get cleaned up?
 '''
 
 import os
+import math
 import time
-import threading
+import shutil
+import selectors
 import subprocess
-try:
-    import Queue
-except ImportError:
-    import queue as Queue
 import numpy
 
 
+# How many threads ffmpeg (CLI or PyAV) may use to decode and filter.  None leaves it to ffmpeg, which may mean one per core;
+# when you are running as many decodes in parallel as you have cores, 1 avoids oversubscribing.
+threads = None
+
+
+# ffmpeg raw format name -> (numpy dtype,  value of full scale)
+SAMPLE_FORMATS = {
+    's16le': (numpy.dtype('<i2'), 32768.),
+    'f32le': (numpy.dtype('<f4'), 1.),
+}
+
+
 def get_length(filename): #, decode=False, debug=False
     """ Gets media length, in seconds, using ffprobe. 
 
@@ -56,74 +68,63 @@ def get_length(filename): #, decode=False, debug=False
         raise ValueError("Failed to read length %s"%(msg,)) from exc
 
 
-def _err_reader(fh, buf, sharedstate):
-    ''' Reads ffmpeg's stderr, in part because it seems the best possible indication of decode errors.
+class DecodeError(ValueError):
+    ''' Decoding failed partway through the audio (as opposed to not being able to open it at all).
+        seconds is how much audio we got out before that, which lets the caller decide that a failure right at the end
+        (e.g. an APEv2 tag that mp3gain added, which isn't valid frame data) is fine.
+        A ValueError, since that is what the decoders raised before, and still do for everything else.
+    '''
+    def __init__(self, msg, seconds=None):
+        ValueError.__init__(self, msg)
+        self.seconds = seconds
 
-        I don't think I can use universal_newlines when I want the same process's stdout to be binary, so we do it ourselves.
+
+def _grow_pipe(fh, size=1048576):
+    ''' Ask for a larger pipe buffer (Linux-only, and silently does nothing elsewhere or when not allowed),
+        which lets ffmpeg decode a little further ahead of us while we are busy with the previous chunk.
     '''
-    line = b''
-    while True:
-        ch = fh.read(1)
-        #print( "READCH=%r"%ch )
-        if len(ch)==0:
-            sharedstate['finished'] = True  # EOF, without having previously quit because errors.
-            if len(line)>0: # output what's left
-                buf.append(line)
-            break
-        if ch in b'\r\n': # newline?  output line
-            #print( '[stderr]'+repr(line) )
-            buf.append(line)
-            line = b''
-        else:
-            line += ch
-            # last line doesn't necessarily get a newline, so test is more interesting
-            if line.startswith(b'Error while decoding stream'):
-                #print( '[stderr]'+repr(line) )
-                sharedstate['failed'] = True
-                # we could break now
-                buf.append(line) # which is incomplete but still useful
-                break
-                #...CONSIDER: not doing so, somehow reading up to EOF
+    try:
+        import fcntl
+        fcntl.fcntl(fh.fileno(), fcntl.F_SETPIPE_SZ, size)
+    except (ImportError, AttributeError, OSError):
+        pass
+
+
+def _err_lines(data, err_lines):
+    ''' Takes what we have of ffmpeg's stderr that wasn't a complete line yet plus what we just read,
+        appends complete lines to err_lines, and returns (the new incomplete last line, how many decode errors were in the complete ones).
 
+        I don't think I can use universal_newlines when I want the same process's stdout to be binary, so we do it ourselves.
+
+        'Error while decoding stream' is ffmpeg telling us it dropped a packet. It keeps going after those,
+        so they are only counted (for debug); whether decoding failed is up to ffmpeg's exit status.
+    '''
+    lines = data.replace(b'\r',b'\n').split(b'\n')
+    rest  = lines.pop() # last line doesn't necessarily get a newline, so is only complete at EOF
+    errors = sum( 1   for line in lines   if b'Error while decoding stream' in line )
+    err_lines.extend( line  for line in lines  if len(line)>0 )
+    return rest, errors
 
-def _out_chunker(fh, output, bytesperchunk, sharedstate):
-    ''' Read ffmpeg's stdout, which contains the raw audio stream, 
-        and puts() its data to output, which is expected to be a queue (because thread-safe).
-        of uint16 numpy arrays arrays.
 
-        Note that we don't do the "did we read 0 bytes" EOF test on this stream (stdout)
-        because it may EOF early when failing on errors.
-        It's actually up to stderr handler to decide whether we finished okay or not.
+class ChunkPool(object):
+    ''' Hands out float32 arrays to convert chunks into.
+        With size 0 that's a new array each time.
+        With size n it cycles through n preallocated arrays,  so an array you were handed is overwritten n chunks later.
     '''
-    bbuffer = b''
-    bytes_seen = 0
-    while len(sharedstate)==0: # will stop on finished or failed
-        justreadbytes = fh.read(bytesperchunk)
-        bbuffer += justreadbytes
-        if len(justreadbytes)==0:  # we're at EOF, but this thread can't itself tell whether we are fine, or crashed.
-            continue
-
-        while len(bbuffer) >= bytesperchunk:
-            #print "regular - current buffer byte len %d,  bytes previously seen %d"%(len(bbuffer),bytes_seen)
-            now = bbuffer[:bytesperchunk]
-            bbuffer = bbuffer[bytesperchunk:]
-            bytes_seen+= len(now)
-            #print "  now returning %d bytes worth of audio; now at %d "%(len(now), bytes_seen)
-            audio = numpy.fromstring(now, dtype=numpy.int16).astype(numpy.float32)
-            output.put( audio ) # will block when full, because queue
-
-        if len(sharedstate)>0:
-            if 'finished' in sharedstate: # then finish up before returning
-                # then there will be fewer than chunk_size bytes left in bbuffer,
-                # which we still want to output
-                bytes_seen+= len(bbuffer)
-                #print "finishing; buflen %d; bytes_seen %d"%(len(bbuffer), bytes_seen)
-                audio = numpy.fromstring(bbuffer, dtype=numpy.int16).astype(numpy.float32)
-                output.put( audio )
-            break
-
-
-def stream_audio(filename, sample_rate, chunk_samples, debug=False):
+    def __init__(self, chunk_samples, size=0):
+        self.chunk_samples = chunk_samples
+        self.arrays = list( numpy.empty(chunk_samples, dtype=numpy.float32)  for _ in range(size) )
+        self.handed = 0
+
+    def get(self, numsamples):
+        if len(self.arrays)==0:
+            return numpy.empty(numsamples, dtype=numpy.float32)
+        ret = self.arrays[ self.handed % len(self.arrays) ]
+        self.handed += 1
+        return ret[:numsamples]
+
+
+def stream_audio(filename, sample_rate, chunk_samples, debug=False, recycle=0, sample_format='s16le'):
     """ Given 
         * any file that ffmpeg can play the audio from,
         * the sample rate you want it in
@@ -132,29 +133,51 @@ def stream_audio(filename, sample_rate, chunk_samples, debug=False):
         Yields a series of float32 numpy arrays (mono, for now)
         which will be chunk_samples-sized (except for the last)
 
+        sample_format is what we ask ffmpeg to output, one of SAMPLE_FORMATS.
+        Values are left at that format's scale, so are within +-32768 for s16le and within +-1.0 for f32le.
+        With f32le, samples reach us without the 16-bit quantization, and without a conversion (just the one copy out of the read buffer).
+
         There are some lefovers from the first version loading the entire song in one numpy array,
         but that was always going to be replaced by streaming - an hour-long track would eat all your RAM.
+
+        ffmpeg's stdout and stderr are both read from this generator, by waiting on both with selectors,
+        so there are no threads to start, and no polling.
+        While we are off handling a chunk, ffmpeg can fill the pipe buffer, and then blocks until we read again.
+
+        stdout is read straight into a reused bytearray (a whole number of chunks big),
+        and each chunk is converted from there into a float32 array, which is the only copy it sees.
+        With recycle=n those float32 arrays come from a pool of n (see ChunkPool) rather than being allocated per chunk,
+        which is kinder to memory on very long files, but means you must be done with a chunk n chunks later
+        (copy it if you want to keep it).
      
         Raises IOError if the file does not exist.
-        Raises ValueError when ffmpeg fails out.
+        Raises DecodeError (after yielding everything ffmpeg did output) when ffmpeg exits with an error.
          There is an interesting footnote to this: the muxer may trip over metadata,
          e.g. the APEb2 tag that mp3gain added, because it's not valid MPEG frame data. 
          This specific example is not uncommon, so you _may_ want to decide that 
-         if a failure is within a second of the end, all is well.
+         if a failure is within a few seconds of the end, all is well (make_mood does).
+         Errors ffmpeg recovers from (a bad packet here and there) are not a failure.
         CONSIDER: make it more defined/known whether we get the last samples, or might quit early.
     """
-    # hardcoded(ish) because it simplifies the only way I currently call it.
-    bytesperchunk = chunk_samples*2 # because 2 bytes per sample, otherwise the numpy conversion is ehh
-    format_string = 's16le'
-    numchannels   = 1  # mono
+    if sample_format not in SAMPLE_FORMATS:
+        raise ValueError('Unknown sample_format %r, we know of %s'%(sample_format, ', '.join(sorted(SAMPLE_FORMATS))))
+    sample_dtype, _ = SAMPLE_FORMATS[sample_format]
+    bytesperchunk = chunk_samples*sample_dtype.itemsize
+    format_string = sample_format
+    numchannels   = 1  # mono. hardcoded(ish) because it simplifies the only way I currently call it.
 
     # TODO: suppress stderr coloring via NO_COLOR
-    command = [
-        'ffmpeg',
+    command = [ 'ffmpeg' ]
+    if threads is not None:
+        command.extend( ['-threads', str(threads),  '-filter_threads', str(threads)] )
+    command += [
         '-i', filename,
         '-f', format_string,      '-acodec', 'pcm_'+format_string,
         '-ar', str(sample_rate),  '-ac', str(numchannels),
-        '-af', 'volume=replaygain=track',
+        # Spell out the downmix: swresample's default one is 0.5*(L+R) for integer output but sqrt(0.5)*(L+R) for float,
+        # so f32le would come out ~1.41x louder than s16le (and than the other decoders, which take the mean of the channels).
+        # rematrix_maxval=1 normalizes that to 0.5*(L+R) either way. aformat makes that aresample the one that does the downmix.
+        '-af', 'volume=replaygain=track,aresample=rematrix_maxval=1.0,aformat=channel_layouts=mono',
         # verbosity of stderr. default is info
         '-v', 'level+info',   
         #'-v', 'level+warning',
@@ -167,70 +190,544 @@ def stream_audio(filename, sample_rate, chunk_samples, debug=False):
         import errno
         raise IOError( errno.ENOENT, os.strerror(errno.ENOENT), filename)
 
-    subproc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,  bufsize=bytesperchunk)
+    subproc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,  bufsize=0)
+    _grow_pipe(subproc.stdout)
 
+    sel = selectors.DefaultSelector()
+    sel.register(subproc.stdout, selectors.EVENT_READ, 'out')
+    sel.register(subproc.stderr, selectors.EVENT_READ, 'err')
 
-    sharedstate = {} # we need an object, to pass around by reference (rather than a primotive, by value).  This could be done more elegantly, yes.
+    # raw buffer is a whole number of chunks, so chunks never straddle its end, and we never have to move leftovers
+    rawbuf    = bytearray( bytesperchunk * max(1, 65536//bytesperchunk) )
+    rawview   = memoryview(rawbuf)
+    filled    = 0 # how far rawbuf has been read into
+    taken     = 0 # how far chunks have been taken out of rawbuf
+    pool      = ChunkPool(chunk_samples, recycle)
+    err_rest  = b''
     err_lines = []
-    out_chunks = Queue.Queue(10) # threadsafe producer/consuner, with a max amount of items.
-    err_thread = threading.Thread(target=_err_reader, args=(subproc.stderr, err_lines, sharedstate))
-    err_thread.start()
-    out_thread = threading.Thread(target=_out_chunker, args=(subproc.stdout, out_chunks, bytesperchunk, sharedstate))
-    out_thread.start()
+    decode_errors = 0
     try:
         seen_samples = 0
-        while True:
-            while out_chunks.qsize()>0:
-                audiosamples = out_chunks.get() # will block, consider using timeout?
+        while len(sel.get_map())>0:
+            for key, _ in sel.select():
+                if key.data == 'err':
+                    data = os.read(key.fd, 65536)
+                    if len(data)==0: # EOF
+                        sel.unregister(key.fileobj)
+                        if len(err_rest)>0: # output what's left
+                            err_lines.append(err_rest)
+                        continue
+                    err_rest, errors = _err_lines(err_rest+data, err_lines)
+                    decode_errors += errors
+                else:
+                    if filled == len(rawbuf): # all taken (see the loop below), start at the beginning again
+                        filled, taken = 0, 0
+                    numread = subproc.stdout.readinto( rawview[filled:] )
+                    if numread==0: # EOF. Note that this alone doesn't tell us whether we finished okay, stderr does.
+                        sel.unregister(key.fileobj)
+                        continue
+                    filled += numread
+
+            while filled-taken >= bytesperchunk:
+                audiosamples = pool.get(chunk_samples)
+                audiosamples[:] = numpy.frombuffer(rawbuf, dtype=sample_dtype, count=chunk_samples, offset=taken)
+                taken += bytesperchunk
                 seen_samples += audiosamples.shape[0]
                 secs = float(seen_samples)/sample_rate
                 if debug:
                     print( "at %d samples, = %.2f seconds, = %dm%02ds"%(seen_samples, secs, secs/60, secs%60 ) )
                 yield audiosamples
-            if 'failed' in sharedstate: # either of those will eventually become true
-                if debug:
-                    print( '[%s] FAILED'%filename )
-                break
-            if 'finished' in sharedstate:
-                if debug:
-                    print( '[%s] FINISHED'%filename )
-                break
-            #retcode = subproc.poll()
-            #if retcode!=None: # so, ffmpeg generally returns nonzero on errors -- but not always.
-            #    deal with quiet success
-            #    it will however tell us it's finished.
-            #    print retcode
-            #    sleep(1) # give the err-reader some time to process all input
-            #    break
-            time.sleep(0.05)
 
-        if debug:
-            print( '[%s] ERRWAIT '%filename )
-        err_thread.join()
-        if debug:
-            print( '[%s] ERRWAITOK '%filename )
+        numsamples = (filled-taken) // sample_dtype.itemsize
+        if numsamples > 0: # the last, shorter chunk
+            audiosamples = pool.get(numsamples)
+            audiosamples[:] = numpy.frombuffer(rawbuf, dtype=sample_dtype, count=numsamples, offset=taken)
+            seen_samples += numsamples
+            yield audiosamples
 
-        # note that in theory, both finished and failed can be set, and failed should take precedence
-        if 'failed' in sharedstate:
-            subproc.terminate() # note: catch   OSError: [Errno 3] No such process
+        # both pipes are at EOF, so it is exiting
+        returncode = subproc.wait()
+        if returncode != 0:
             if debug:
-                print( '\n'.join(err_lines[-4:]) )
-            #raise ValueError('ffmpeg reported decode failure for %r'%filename)
-
+                print( '[%s] FAILED (exit status %d)'%(filename, returncode) )
+                print( '\n'.join( line.decode('utf8','replace')  for line in err_lines[-4:]) )
+            raise DecodeError('ffmpeg reported decode failure for %r at %.1f sec'%(filename, float(seen_samples)/sample_rate),
+                              seconds=float(seen_samples)/sample_rate)
         if debug:
-            print( '[%s] OUTWAIT '%filename )
-        out_thread.join()
-        if debug:
-            print( '[%s] OUTWAITOK '%filename )
-
-        if 'failed' in sharedstate:
-            raise ValueError('ffmpeg reported decode failure for %r'%filename)
+            print( '[%s] FINISHED (%d recovered decode errors)'%(filename, decode_errors) )
 
     finally:
+        rawview.release()
+        sel.close()
+        if subproc.poll() is None: # we stopped early (failure, or the consumer stopped iterating)
+            subproc.terminate()
+        subproc.stdout.close()
+        subproc.stderr.close()
+        subproc.wait()
+
+
+### Decoder backends ##########################
+# make_mood wants a float32 chunk stream, and the duration.
+# The ffmpeg CLI (above) always works if ffmpeg is installed, but is two processes per file (ffprobe and ffmpeg),
+# so when an in-process library is installed we prefer that.
+
+
+class StreamResampler(object):
+    ''' Polyphase resampling (scipy's resample_poly) of a stream that arrives in pieces of any size,
+        giving the same output as resampling the whole thing in one go.
+
+        It works by resampling overlapping segments: each one includes enough input on either side (self.context)
+        for the filter, and starts at a multiple of the decimation factor so the output grids line up.
+        That means output lags input by a little context, which flush() gives you at the end.
+    '''
+    def __init__(self, from_rate, to_rate):
+        g = math.gcd( int(from_rate), int(to_rate) )
+        self.up   = int(to_rate)//g
+        self.down = int(from_rate)//g
+        # resample_poly's filter reaches 10*max(up,down) samples on the upsampled grid, i.e. that/up input samples
+        need = 10*max(self.up, self.down)/float(self.up) + 2
+        self.context = self.down * int(math.ceil( need/self.down ))
+        self.buf     = numpy.zeros(0, dtype=numpy.float32)
+        self.bufpos  = 0 # input position of buf[0]
+        self.done_to = 0 # input position up to which we have output (a multiple of down)
+
+    def _resample(self, end, final):
+        import scipy.signal
+        left = max(0, self.done_to - self.context)
+        if final:
+            seg = self.buf[ left-self.bufpos : ]
+        else:
+            seg = self.buf[ left-self.bufpos : end+self.context-self.bufpos ]
+        resampled = scipy.signal.resample_poly(seg, self.up, self.down)
+        start = (self.done_to-left)*self.up//self.down
+        if final:
+            ret = resampled[start:]
+        else:
+            ret = resampled[start : start + (end-self.done_to)*self.up//self.down]
+        self.done_to = end
+        keep = max(0, self.done_to - self.context)
+        self.buf    = self.buf[ keep-self.bufpos : ]
+        self.bufpos = keep
+        return ret.astype(numpy.float32)
+
+    def feed(self, samples):
+        ''' Takes the next input samples, returns what output can be calculated so far (possibly nothing) '''
+        if self.up == self.down:
+            return samples
+        self.buf = numpy.concatenate( (self.buf, samples) )
+        end = ( (self.bufpos+len(self.buf)-self.context)//self.down )*self.down
+        if end <= self.done_to:
+            return numpy.zeros(0, dtype=numpy.float32)
+        return self._resample(end, False)
+
+    def flush(self):
+        ''' At the end of input: returns the rest of the output '''
+        if self.up == self.down:
+            return numpy.zeros(0, dtype=numpy.float32)
+        return self._resample(self.bufpos+len(self.buf), True)
+
+
+def rechunk(pieces, chunk_samples, recycle=0, scale=1.):
+    ''' Takes an iterable of 1D sample arrays of any size, 
+        yields chunk_samples-sized float32 arrays (except for the last), like stream_audio does.
+        Samples are copied once, into arrays from a ChunkPool (see stream_audio for what recycle means),
+        and multiplied by scale on the way.
+    '''
+    pool   = ChunkPool(chunk_samples, recycle)
+    out    = None
+    filled = 0
+    for piece in pieces:
+        pos = 0
+        while pos < len(piece):
+            if out is None:
+                out = pool.get(chunk_samples)
+            n = min( chunk_samples-filled, len(piece)-pos )
+            if scale == 1.:
+                out[filled:filled+n] = piece[pos:pos+n]
+            else:
+                numpy.multiply( piece[pos:pos+n], scale, out=out[filled:filled+n] )
+            filled += n
+            pos    += n
+            if filled == chunk_samples:
+                yield out
+                out, filled = None, 0
+    if filled > 0:
+        yield out[:filled]
+
+
+def replaygain_factor(metadata):
+    ''' Given a dict of tags, returns the amplitude factor for the track ReplayGain, 
+        limited so the track peak doesn't clip, like ffmpeg's  volume=replaygain=track  does by default.
+        Returns 1.0 when there are no such tags.
+    '''
+    tags = dict( (k.lower(), v)  for k,v in metadata.items() )
+    try:
+        gain = float( tags['replaygain_track_gain'].lower().replace('db','').strip() )
+    except (KeyError, ValueError):
+        return 1.
+    factor = 10.**(gain/20.)
+    try:
+        peak = float( tags['replaygain_track_peak'] )
+        if peak > 0:
+            factor = min(factor, 1./peak)
+    except (KeyError, ValueError):
         pass
-        # TODO: remember what cleanup we need to do exactly.
-        #subproc.stdout.close()
-        #subproc.stderr.close()
+    return factor
+
+
+def _no_such_file(filename):
+    import errno
+    return IOError( errno.ENOENT, os.strerror(errno.ENOENT), filename)
+
+
+class Decoder(object):
+    ''' What a decoder backend looks like. Use open_decoder() to get one.
+
+        - duration()   returns the length in seconds
+        - chunks()     yields float32 arrays, like stream_audio() (including chunk_samples, recycle, and sample_format scale)
+        - close()      if you decide not to call chunks() after all (chunks() closes when done)
+
+        Errors while decoding are raised as DecodeError (a ValueError, with how far we got), whatever the library underneath raised.
+        Errors opening the file are raised as ValueError.
+    '''
+    name       = None
+    extensions = None # lowercase extensions it should be used for, None meaning anything
+
+    @classmethod
+    def available(cls):
+        return True
+
+    @classmethod
+    def handles(cls, filename):
+        if cls.extensions is None:
+            return True
+        return filename.lower().rsplit('.',1)[-1] in cls.extensions
+
+    def __init__(self, filename, sample_rate, sample_format='s16le'):
+        if sample_format not in SAMPLE_FORMATS:
+            raise ValueError('Unknown sample_format %r, we know of %s'%(sample_format, ', '.join(sorted(SAMPLE_FORMATS))))
+        if not os.path.exists( filename ):
+            raise _no_such_file(filename)
+        self.filename      = filename
+        self.sample_rate   = sample_rate
+        self.sample_format = sample_format
+        self.scale         = SAMPLE_FORMATS[sample_format][1] # the in-process libraries give us floats in -1..1
+
+    def duration(self):
+        raise NotImplementedError()
+
+    def chunks(self, chunk_samples, recycle=0):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class FFmpegCLIDecoder(Decoder):
+    ''' The ffmpeg and ffprobe executables, i.e. get_length() and stream_audio() '''
+    name = 'ffmpeg'
+
+    @classmethod
+    def available(cls):
+        return shutil.which('ffmpeg') is not None
+
+    def duration(self):
+        return get_length(self.filename)
+
+    def chunks(self, chunk_samples, recycle=0):
+        return stream_audio(self.filename, self.sample_rate, chunk_samples, recycle=recycle, sample_format=self.sample_format)
+
+
+def _av_error(av):
+    ' PyAV renamed its base exception at some point '
+    return getattr(av, 'FFmpegError', None) or av.AVError
+
+
+class PyAVDecoder(Decoder):
+    ''' In-process decoding via PyAV (ffmpeg's libraries), so handles everything the CLI does.
+        Applies track ReplayGain from the tags, to match what we ask of the CLI.
+    '''
+    name = 'pyav'
+
+    @classmethod
+    def available(cls):
+        try:
+            import av
+            return True
+        except ImportError:
+            return False
+
+    def __init__(self, filename, sample_rate, sample_format='s16le'):
+        Decoder.__init__(self, filename, sample_rate, sample_format)
+        import av
+        try:
+            self.container = av.open(filename)
+            self.stream    = self.container.streams.audio[0]
+        except IndexError:
+            self.container.close()
+            raise ValueError('Failed to read length - seems to not be audio file: %r'%filename)
+        except _av_error(av) as exc:
+            raise ValueError('PyAV failed to open %r: %s'%(filename, exc)) from exc
+        if threads is not None:
+            self.stream.codec_context.thread_count = threads
+        metadata = dict(self.container.metadata)
+        metadata.update( self.stream.metadata )
+        self.scale *= replaygain_factor(metadata)
+
+    def duration(self):
+        if self.stream.duration is not None and self.stream.time_base is not None:
+            return float( self.stream.duration * self.stream.time_base )
+        if self.container.duration is not None:
+            return self.container.duration / 1000000. # in AV_TIME_BASE
+        raise ValueError('Failed to read length of %r'%self.filename)
+
+    def _pieces(self):
+        import av
+        # We downmix ourselves rather than ask for layout='mono': we can't give PyAV's resampler swresample options,
+        # and its default float downmix is sqrt(0.5)*(L+R), not the 0.5*(L+R) the other backends use.
+        resampler = av.AudioResampler(format='flt', rate=self.sample_rate)
+        nsamples  = 0
+        def mono(rframe): # packed, so (1, samples*channels)
+            return rframe.to_ndarray().reshape(-1, len(rframe.layout.channels)).mean(axis=1, dtype=numpy.float32)
+        try:
+            for frame in self.container.decode(self.stream):
+                frame.pts = None # we only care about the samples, and this avoids complaints about odd timestamps
+                for rframe in resampler.resample(frame):
+                    piece = mono(rframe)
+                    nsamples += len(piece)
+                    yield piece
+            for rframe in resampler.resample(None): # flush
+                yield mono(rframe)
+        except _av_error(av) as exc:
+            seconds = float(nsamples) / self.sample_rate
+            raise DecodeError('PyAV reported decode failure for %r at %.1f sec: %s'%(self.filename, seconds, exc), seconds=seconds) from exc
+        finally:
+            self.container.close()
+
+    def chunks(self, chunk_samples, recycle=0):
+        return rechunk( self._pieces(), chunk_samples, recycle=recycle, scale=self.scale )
+
+    def close(self):
+        self.container.close()
+
+
+class SoundfileDecoder(Decoder):
+    ''' In-process decoding via soundfile (libsndfile), for the formats that handles.
+        Does its own downmix and resampling (see StreamResampler).
+        Note that libsndfile doesn't tell us tags, so no ReplayGain is applied,
+        which is why DECODERS prefers the ffmpeg CLI over this, and it's only picked when there is no ffmpeg.
+    '''
+    name       = 'soundfile'
+    extensions = ('wav', 'flac', 'ogg', 'aiff', 'aif')
+
+    @classmethod
+    def available(cls):
+        try:
+            import soundfile
+            return True
+        except (ImportError, OSError): # OSError: module is there, libsndfile isn't
+            return False
+
+    def __init__(self, filename, sample_rate, sample_format='s16le'):
+        Decoder.__init__(self, filename, sample_rate, sample_format)
+        import soundfile
+        try:
+            self.sf = soundfile.SoundFile(filename)
+        except RuntimeError as exc: # which soundfile's own errors subclass
+            raise ValueError('soundfile failed to open %r: %s'%(filename, exc)) from exc
+
+    def duration(self):
+        return float(self.sf.frames) / self.sf.samplerate   # exact, from the header
+
+    def _pieces(self):
+        resampler = StreamResampler(self.sf.samplerate, self.sample_rate)
+        frames    = 0
+        try:
+            for block in self.sf.blocks(blocksize=65536, dtype='float32', always_2d=True):
+                mono = block.mean(axis=1) # 0.5*(L+R) for stereo, as stream_audio asks of ffmpeg, so that levels match the other backends
+                frames += len(block)
+                yield resampler.feed( mono )
+            yield resampler.flush()
+        except RuntimeError as exc:
+            seconds = float(frames) / self.sf.samplerate
+            raise DecodeError('soundfile reported decode failure for %r at %.1f sec: %s'%(self.filename, seconds, exc), seconds=seconds) from exc
+        finally:
+            self.sf.close()
+
+    def chunks(self, chunk_samples, recycle=0):
+        return rechunk( self._pieces(), chunk_samples, recycle=recycle, scale=self.scale )
+
+    def close(self):
+        self.sf.close()
+
+
+def parse_wav_header(filename):
+    ''' Reads the header of a RIFF/WAVE file (or RF64, which is what >4GB WAVs should be), 
+        returns a dict with 
+        - source_dtype  for the samples, see PCMMemmapDecoder
+        - channels, source_rate
+        - offset        of the sample data in the file
+        - frames        the amount of sample frames (limited to what is actually in the file, as some writers get the size wrong)
+        Raises ValueError if it isn't a WAV file, or a kind of WAV that isn't plain PCM or float.
+    '''
+    import struct
+    filesize = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] not in (b'RIFF', b'RF64') or riff[8:12] != b'WAVE':
+            raise ValueError('Not a RIFF WAVE file: %r'%filename)
+        fmt       = None
+        ds64_size = None
+        while True:
+            chunkhead = f.read(8)
+            if len(chunkhead) < 8:
+                raise ValueError('No data chunk in %r'%filename)
+            chunkid, chunksize = struct.unpack('<4sI', chunkhead)
+            if chunkid == b'ds64': # RF64: the real sizes are here, the RIFF ones are 0xFFFFFFFF
+                _, ds64_size = struct.unpack('<QQ', f.read(16))
+                f.seek(chunksize-16, 1)
+            elif chunkid == b'fmt ':
+                fmtdata = f.read(chunksize)
+                fmt = struct.unpack('<HHIIHH', fmtdata[:16])
+                if fmt[0] == 0xFFFE and len(fmtdata) >= 26: # WAVE_FORMAT_EXTENSIBLE: the real format is the start of the subformat GUID
+                    fmt = (struct.unpack('<H', fmtdata[24:26])[0],) + fmt[1:]
+            elif chunkid == b'data':
+                if fmt is None:
+                    raise ValueError('data before fmt chunk in %r'%filename)
+                offset = f.tell()
+                if ds64_size is not None and chunksize == 0xFFFFFFFF:
+                    chunksize = ds64_size
+                break
+            else:
+                f.seek(chunksize + (chunksize%2), 1) # chunks are word-aligned
+    formattag, channels, source_rate, _, blockalign, bits = fmt
+    kinds = { (1,8):'u1',  (1,16):'<i2',  (1,24):'<i3',  (1,32):'<i4',  (3,32):'<f4',  (3,64):'<f8' }
+    if (formattag, bits) not in kinds or channels < 1:
+        raise ValueError('WAV with format %d, %d bits is not plain PCM/float we can map: %r'%(formattag, bits, filename))
+    chunksize = min(chunksize, filesize-offset)
+    return { 'source_dtype':kinds[(formattag,bits)],  'channels':channels,  'source_rate':source_rate,
+             'offset':offset,  'frames':chunksize // blockalign }
+
+
+class PCMMemmapDecoder(Decoder):
+    ''' Decoding that isn't: uncompressed samples are memory-mapped (numpy.memmap) and read in place,
+        so no process, no pipe, and the page cache does the I/O (and is shared by everything reading the same file).
+        Does its own downmix and resampling (see StreamResampler), like SoundfileDecoder.
+
+        You construct this directly for raw PCM, since that says nothing about its layout:
+        - source_dtype  '<i2' (16-bit), '<i3' (24-bit), '<i4', 'u1' (8-bit, unsigned), '<f4', '<f8'
+        - channels, source_rate
+        - offset, frames   where the samples start, and how many frames (default: the rest of the file)
+        Defaults are CD layout.  WavMemmapDecoder reads all that from the header.
+    '''
+    name       = 'pcm'
+    extensions = () # never picked automatically, see above
+
+    fullscale = { 'u1':128., '<i2':32768., '<i3':8388608., '<i4':2147483648., '<f4':1., '<f8':1. }
+
+    def __init__(self, filename, sample_rate, sample_format='s16le', source_dtype='<i2', channels=2, source_rate=44100, offset=0, frames=None):
+        Decoder.__init__(self, filename, sample_rate, sample_format)
+        if source_dtype not in self.fullscale:
+            raise ValueError('Unknown source_dtype %r'%source_dtype)
+        self.source_dtype = source_dtype
+        self.channels     = channels
+        self.source_rate  = source_rate
+        if source_dtype == '<i3': # numpy has no 24-bit int, so map the bytes
+            mapdtype, samplebytes = numpy.uint8, 3
+        else:
+            mapdtype = numpy.dtype(source_dtype)
+            samplebytes = mapdtype.itemsize
+        if frames is None:
+            frames = (os.path.getsize(filename)-offset) // (samplebytes*channels)
+        self.frames = frames
+        shape = (frames, channels, 3)  if source_dtype=='<i3'  else  (frames, channels)
+        self.samples = numpy.memmap(filename, dtype=mapdtype, mode='r', offset=offset, shape=shape)
+
+    def duration(self):
+        return float(self.frames) / self.source_rate   # exact
+
+    def _mono(self, block):
+        ''' sample frames -> mono float32 at -1..1 scale '''
+        if self.source_dtype == '<i3':
+            block = ( (block[...,2].astype(numpy.int32) << 24) | (block[...,1].astype(numpy.int32) << 16) | (block[...,0].astype(numpy.int32) << 8) ) >> 8
+        # the mean of the channels, i.e. 0.5*(L+R) for stereo, like the other backends
+        if self.channels == 2:
+            mono = block[:,0].astype(numpy.float32)
+            mono += block[:,1]
+            mono *= 0.5 / self.fullscale[self.source_dtype]
+        else:
+            mono = block.mean(axis=1, dtype=numpy.float32)
+            mono /= self.fullscale[self.source_dtype]
+        if self.source_dtype == 'u1':
+            mono -= 1.
+        return mono
+
+    def _pieces(self):
+        blockframes = 65536
+        if self.source_rate == self.sample_rate and self.channels == 1 and self.source_dtype not in ('<i3','u1'):
+            # nothing to do but the conversion, which rechunk does on its way into the chunk arrays
+            for start in range(0, self.frames, blockframes):
+                yield self.samples[start:start+blockframes, 0]
+            return
+        resampler = StreamResampler(self.source_rate, self.sample_rate)
+        for start in range(0, self.frames, blockframes):
+            yield resampler.feed( self._mono( self.samples[start:start+blockframes] ) )
+        yield resampler.flush()
+
+    def chunks(self, chunk_samples, recycle=0):
+        scale = self.scale
+        if self.source_rate == self.sample_rate and self.channels == 1 and self.source_dtype not in ('<i3','u1'):
+            scale /= self.fullscale[self.source_dtype]  # since _pieces gives the samples as they are
+        return rechunk( self._pieces(), chunk_samples, recycle=recycle, scale=scale )
+
+    def close(self):
+        del self.samples # numpy.memmap has no close, the mapping goes away with the last reference
+
+
+class WavMemmapDecoder(PCMMemmapDecoder):
+    ''' PCMMemmapDecoder for plain PCM/float WAV files, with the layout from the header '''
+    name       = 'wavmmap'
+    extensions = ('wav',)
+
+    @classmethod
+    def handles(cls, filename):
+        if not super(WavMemmapDecoder, cls).handles(filename): # extension
+            return False
+        try:
+            parse_wav_header(filename)
+            return True
+        except (ValueError, IOError): # e.g. ADPCM, or mislabeled; leave it to the other decoders
+            return False
+
+    def __init__(self, filename, sample_rate, sample_format='s16le'):
+        Decoder.__init__(self, filename, sample_rate, sample_format) # does the existence check before we open it
+        PCMMemmapDecoder.__init__(self, filename, sample_rate, sample_format, **parse_wav_header(filename))
+
+
+# in order of preference.  soundfile comes after the CLI because it can't apply ReplayGain, so would give different moods for tagged files
+DECODERS = [WavMemmapDecoder, PyAVDecoder, FFmpegCLIDecoder, SoundfileDecoder, PCMMemmapDecoder]
+
+
+def open_decoder(filename, sample_rate, sample_format='s16le', backend=None):
+    ''' Returns a Decoder for this file.
+        backend is a Decoder name ('wavmmap', 'pyav', 'ffmpeg', 'soundfile', 'pcm'), or None to pick
+        the first one in DECODERS that is installed and handles this file, which is usually PyAV or the ffmpeg CLI
+        (soundfile only when there is no ffmpeg executable, and if nothing fits we try the CLI anyway, to fail with its error).
+        ('pcm' is raw 16-bit stereo 44.1kHz; for other raw layouts, construct a PCMMemmapDecoder yourself)
+    '''
+    if not os.path.exists( filename ): # before we try things that would give less clear errors
+        raise _no_such_file(filename)
+    if backend is not None:
+        for cls in DECODERS:
+            if cls.name == backend:
+                if not cls.available():
+                    raise ValueError('decoder backend %r is not installed'%backend)
+                return cls(filename, sample_rate, sample_format)
+        raise ValueError('Unknown decoder backend %r, we know of %s'%(backend, ', '.join( cls.name  for cls in DECODERS)))
+    for cls in DECODERS:
+        if cls.available() and cls.handles(filename):
+            return cls(filename, sample_rate, sample_format)
+    return FFmpegCLIDecoder(filename, sample_rate, sample_format)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,28 @@
+''' Writing files so that readers (a music player, a web server, the next scan) never see them half-written.
+'''
+import os
+
+
+def temp_path_for(path):
+    ''' Where replace_atomically writes before the rename:
+        the same directory (a rename is only atomic within a filesystem), hidden, and unique per process,
+        e.g. /music/a.mood -> /music/.a.mood.tmp1234
+    '''
+    return os.path.join( os.path.dirname(path), '.%s.tmp%d'%(os.path.basename(path), os.getpid()) )
+
+
+def replace_atomically(path, write):
+    ''' Calls write(temporary path) and then renames that over path,
+        so that path is never seen half-written, even if we are killed halfway.
+        If write (or the rename) raises, the temporary file is removed and the exception goes through.
+    '''
+    tmppath = temp_path_for(path)
+    try:
+        write(tmppath)
+        os.replace(tmppath, path)
+    except BaseException:
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+        raise
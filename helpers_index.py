@@ -0,0 +1,278 @@
+''' On-disk state for moodbar-generate's recursive mode, using nothing beyond the standard library.
+
+    ScanIndex remembers, per directory, its mtime and what was in it (in sqlite),
+    so that a later scan can skip listing directories that haven't changed since.
+
+    Journal is an append-only log of a run's jobs, so that an interrupted run can be picked up where it was.
+
+    FailureCache remembers files we failed on (in its own sqlite file next to the index), so that we don't keep retrying them.
+'''
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+def default_index_path():
+    ' where the index lives unless told otherwise: under $XDG_CACHE_HOME, or ~/.cache '
+    cachedir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cachedir, 'moodbar-generate', 'index.sqlite')
+
+
+def default_failures_path(index_path=None):
+    ' the failure cache goes next to the index (a separate file, so that neither one\'s writes wait on the other\'s) '
+    if index_path is None:
+        index_path = default_index_path()
+    return os.path.join( os.path.dirname(index_path), 'failures.sqlite' )
+
+
+def _state_path(name):
+    return os.path.join( os.path.dirname(default_index_path()), name )
+
+
+def open_db(filename, check_same_thread=True, autocommit=False):
+    ''' opens (creating if necessary) the sqlite file, and the directory it goes in.
+        autocommit=True means every statement is its own transaction, so the connection never sits on a write lock.
+    '''
+    dirn = os.path.dirname(filename)
+    if dirn and not os.path.isdir(dirn):
+        os.makedirs(dirn)
+    # the timeout is how long to wait on another connection's lock (e.g. a second run), sqlite's default of 5s is easily hit
+    conn = sqlite3.connect(filename, timeout=60., check_same_thread=check_same_thread,
+                           isolation_level=None if autocommit else '')
+    conn.execute('PRAGMA journal_mode=WAL') # the scan writes while other runs may read
+    return conn
+
+
+class ScanIndex(object):
+    ''' Directory mtime changes whenever an entry is added, removed or renamed in it (not when a file's contents change),
+        and that includes our own sidecar files being written.   So as long as a directory's mtime is the same as last time,
+        the names we stored for it are still its contents, and we can classify from those without listing it.
+
+        We store the names, not what we decided about them, so that changing options (or --redo-age's clock) are still respected.
+
+        Directories changed in the last few seconds are stored as always-stale,
+        since a change within the same mtime tick as our listing wouldn't show.
+    '''
+    racy_sec = 2.
+
+    def __init__(self, filename=None, rescan=False):
+        ''' filename defaults to default_index_path()
+            rescan=True ignores what is stored (everything is listed again) but still updates it.
+        '''
+        if filename is None:
+            filename = default_index_path()
+        self.filename = filename
+        self.rescan   = rescan
+        self.conn     = open_db(filename)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS scandirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, subdirs TEXT, filenames TEXT)')
+        self.unchanged = 0  # counts, for reporting
+        self.listed    = 0
+        self._pending  = 0
+
+    def get(self, path, mtime_ns):
+        ''' Returns (subdir names, filenames) as stored for path, if it is stored with this mtime.  None if not. '''
+        if self.rescan:
+            return None
+        row = self.conn.execute('SELECT subdirs, filenames FROM scandirs WHERE path=? AND mtime_ns=?', (path, mtime_ns)).fetchone()
+        if row is None:
+            return None
+        self.unchanged += 1
+        return json.loads(row[0]), json.loads(row[1])
+
+    def put(self, path, mtime_ns, subdirs, filenames):
+        ''' Store what we just listed for a directory (that had that mtime before we listed it). '''
+        self.listed += 1
+        if time.time() - mtime_ns/1e9 < self.racy_sec:
+            mtime_ns = -1 # will never match
+        self.conn.execute('INSERT OR REPLACE INTO scandirs (path, mtime_ns, subdirs, filenames) VALUES (?,?,?,?)',
+                          (path, mtime_ns, json.dumps(subdirs), json.dumps(filenames)))
+        self._pending += 1
+        if self._pending >= 1000: # so that an interrupted scan keeps most of its work
+            self.commit()
+
+    def prune(self, root, visited):
+        ''' After a complete scan of root: forget directories under it that weren't visited (because they were removed) '''
+        rows = self.conn.execute('SELECT path FROM scandirs WHERE path=? OR (path>? AND path<?)',
+                                 (root, root.rstrip('/')+'/', root.rstrip('/')+'0')).fetchall()   # '0' sorts right after '/'
+        gone = list( (path,)  for path, in rows  if path not in visited )
+        self.conn.executemany('DELETE FROM scandirs WHERE path=?', gone)
+        self.commit()
+        return len(gone)
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+class Journal(object):
+    ''' Append-only log of a batch run: a line when a job is queued, and a line with its outcome when it's done
+        (JSON per line, so a line cut off by a crash is recognizably broken, and skipped).
+    
+        If a run is interrupted, the next run over the same directories replay()s it,
+        to get the jobs that were queued but never finished (including ones killed halfway), and can start on those right away.
+        A run that completes calls finish(), which removes the journal.
+    '''
+    sync_sec = 5.  # fsync at most this often, so that we survive a reboot without paying for a sync per job
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock     = threading.Lock()
+        self.synced   = time.time()
+        self.f        = None
+
+    @classmethod
+    def for_roots(cls, roots):
+        ' a Journal in the default place, specific to this set of root directories '
+        key = hashlib.sha1( '\0'.join(sorted(roots)).encode('utf8', 'surrogateescape') ).hexdigest()[:16]
+        return cls( _state_path('journal-%s.jsonl'%key) )
+
+    def replay(self):
+        ''' Returns the filenames that an earlier (interrupted) run queued but has no outcome for, in the order they were queued.
+            Starts the journal afresh, since those are about to be queued again.
+        '''
+        pending = {} # dicts keep order
+        try:
+            with open(self.filename, 'rb') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line.decode('utf8', 'surrogateescape'))
+                    except ValueError: # probably the last line, cut off
+                        continue
+                    if rec.get('op') == 'queued':
+                        pending[rec['ffn']] = True
+                    elif rec.get('op') == 'done':
+                        pending.pop(rec['ffn'], None)
+        except (IOError, OSError):
+            pass
+        self._open('wb')
+        return list(pending)
+
+    def _open(self, mode='ab'):
+        if self.f is None or mode == 'wb':
+            if self.f is not None:
+                self.f.close()
+            dirn = os.path.dirname(self.filename)
+            if dirn and not os.path.isdir(dirn):
+                os.makedirs(dirn)
+            self.f = open(self.filename, mode)
+
+    def _append(self, rec):
+        with self.lock:
+            self._open()
+            self.f.write( (json.dumps(rec)+'\n').encode('utf8', 'surrogateescape') )
+            self.f.flush()
+            if time.time() - self.synced > self.sync_sec:
+                os.fsync( self.f.fileno() )
+                self.synced = time.time()
+
+    def queued(self, ffn):
+        self._append( {'op':'queued', 'ffn':ffn} )
+
+    def done(self, ffn, status):
+        self._append( {'op':'done', 'ffn':ffn, 'status':status, 't':round(time.time(),1)} )
+
+    def finish(self):
+        ' the run completed, so there is nothing to resume '
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+            try:
+                os.unlink(self.filename)
+            except OSError:
+                pass
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.flush()
+                os.fsync( self.f.fileno() )
+                self.f.close()
+                self.f = None
+
+
+class FailureCache(object):
+    ''' Files we failed to make a mood for, keyed by path, size and mtime, so that a changed file counts as a new one.
+        Each has a reason ('too short', 'not audio', 'decode error'), a detail string, how many attempts we made, and when.
+
+        should_skip() applies the retry policy: after a failure, wait retry_days before trying again,
+        doubling with each further failure (so the occasional transient problem gets retried, and the truly broken ever more rarely).
+        retry_days=0 means always retry (but still record).
+
+        Used from more than one thread (the scan asks, the pool's result handler records), so the connection is shared, behind a lock.
+        It is in autocommit mode, so that no statement leaves a transaction (and with it a lock on the file) open.
+    '''
+    def __init__(self, filename=None, retry_days=7.):
+        if filename is None:
+            filename = default_failures_path()
+        self.retry_days = retry_days
+        self.lock       = threading.Lock()
+        self.conn       = open_db(filename, check_same_thread=False, autocommit=True)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS failures (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,
+                                                                  reason TEXT, detail TEXT, attempts INTEGER, first REAL, last REAL)''')
+        self.skipped = 0
+
+    def _key(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def should_skip(self, path, now=None):
+        ''' whether path failed before (and hasn't changed since), and isn't due for a retry yet '''
+        if not self.retry_days:
+            return False
+        with self.lock:
+            row = self.conn.execute('SELECT size, mtime_ns, attempts, last FROM failures WHERE path=?', (path,)).fetchone()
+        if row is None:
+            return False
+        size, mtime_ns, attempts, last = row
+        if self._key(path) != (size, mtime_ns): # changed, so worth a new try (record() will reset the count if it fails again)
+            return False
+        if now is None:
+            now = time.time()
+        skip = now < last + self.retry_after(attempts)
+        if skip:
+            self.skipped += 1
+        return skip
+
+    def retry_after(self, attempts):
+        ''' seconds to wait after the attempts'th failure '''
+        return 86400. * self.retry_days * 2**max(0, attempts-1)
+
+    def record(self, path, reason, detail=''):
+        ' note a failure '
+        key = self._key(path)
+        if key is None:
+            return
+        now = time.time()
+        with self.lock: # (the lock also keeps the read and the write together, since we are the only writer in this process)
+            row = self.conn.execute('SELECT size, mtime_ns, attempts, first FROM failures WHERE path=?', (path,)).fetchone()
+            attempts, first = 1, now
+            if row is not None and tuple(row[:2]) == key: # same file failing again
+                attempts, first = row[2]+1, row[3]
+            self.conn.execute('INSERT OR REPLACE INTO failures (path, size, mtime_ns, reason, detail, attempts, first, last) VALUES (?,?,?,?,?,?,?,?)',
+                              (path, key[0], key[1], reason, detail, attempts, first, now))
+
+    def forget(self, path):
+        ' e.g. when it worked after all '
+        with self.lock:
+            self.conn.execute('DELETE FROM failures WHERE path=?', (path,))
+
+    def entries(self):
+        ' all failures, as dicts, sorted by reason and path '
+        with self.lock:
+            rows = self.conn.execute('SELECT path, size, mtime_ns, reason, detail, attempts, first, last FROM failures ORDER BY reason, path').fetchall()
+        return list( dict(zip(('path','size','mtime_ns','reason','detail','attempts','first','last'), row))   for row in rows )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,135 @@
+''' Minimal inotify (Linux only) via ctypes, so that it needs no extra library.
+
+    Watches are per directory, so for a tree you add each directory (add_tree),
+    and directories that appear later yourself when you see them created or moved in.
+'''
+import os
+import sys
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+
+
+IN_MODIFY      = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000  # the kernel's event queue overflowed, so we missed things
+IN_IGNORED     = 0x00008000  # the watch went away (directory deleted, or rm_watch)
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+TREE_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+_event_head = struct.Struct('iIII') # wd, mask, cookie, len  (then len bytes of NUL-padded name)
+
+_libc = None
+
+
+def available():
+    return sys.platform.startswith('linux')
+
+
+def _lib():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        _libc.inotify_init1.argtypes     = [ctypes.c_int]
+        _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc.inotify_rm_watch.argtypes  = [ctypes.c_int, ctypes.c_int]
+    return _libc
+
+
+class Inotify(object):
+    ''' One inotify instance.
+        read() gives (path, mask, cookie) tuples, path being the directory joined with the name the event is about.
+    '''
+    def __init__(self):
+        if not available():
+            raise OSError('inotify is Linux-only')
+        self.fd = _lib().inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, 'inotify_init1: %s'%os.strerror(e))
+        self.paths = {} # wd -> directory path
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask=TREE_MASK):
+        ''' Returns the watch descriptor, or None if the directory is unreadable or gone by now.
+            Raises OSError when we hit the watch limit (see /proc/sys/fs/inotify/max_user_watches)
+        '''
+        wd = _lib().inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.EACCES, errno.ENOTDIR):
+                return None
+            if e == errno.ENOSPC:
+                raise OSError(e, 'Out of inotify watches at %r, consider raising /proc/sys/fs/inotify/max_user_watches'%path)
+            raise OSError(e, 'inotify_add_watch %r: %s'%(path, os.strerror(e)))
+        self.paths[wd] = path # same directory (inode) gives the same wd, so this also follows renames
+        return wd
+
+    def add_tree(self, root, mask=TREE_MASK):
+        ''' Watches root and all directories under it (not following symlinks). Returns how many we added. '''
+        added = 0
+        todo  = [root]
+        while len(todo) > 0:
+            path = todo.pop()
+            if self.add_watch(path, mask) is None:
+                continue
+            added += 1
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            todo.append( entry.path )
+            except OSError:
+                pass
+        return added
+
+    def read(self, timeout=None):
+        ''' Waits up to timeout seconds (None: forever) for events, returns a list of (path, mask, cookie), possibly empty.
+            An IN_Q_OVERFLOW event has path None.
+        '''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if len(ready) == 0:
+            return []
+        data = os.read(self.fd, 65536)
+        ret  = []
+        pos  = 0
+        while pos + _event_head.size <= len(data):
+            wd, mask, cookie, namelen = _event_head.unpack_from(data, pos)
+            pos += _event_head.size
+            name = data[pos:pos+namelen].rstrip(b'\0')
+            pos += namelen
+
+            if mask & IN_Q_OVERFLOW:
+                ret.append( (None, mask, cookie) )
+                continue
+            dirpath = self.paths.get(wd)
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            if dirpath is None:
+                continue
+            if len(name) > 0:
+                ret.append( (os.path.join(dirpath, os.fsdecode(name)), mask, cookie) )
+            else: # about the watched directory itself
+                ret.append( (dirpath, mask, cookie) )
+        return ret
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -2,7 +2,7 @@
 
     I may implement it in something more portable once I'm satisfied. I may be too lazy.
 
-    Mono 16-bit is hardcoded in places.  Sample rate could be more easily changed.
+    Mono is hardcoded in places.  Sample rate could be more easily changed.
 
     Two-process and takes more than one core, but less than two fully because ffmpeg is held up by our calculations.
 
@@ -15,8 +15,9 @@
 '''
 
 import os
-import array
 import math
+import struct
+import functools
 
 import numpy
 import numpy.fft
@@ -90,6 +91,38 @@ def bark(hz):
     return _bark_lut[hz]
 
 
+_bmcache = {}
+def bark_band_matrix(sample_rate, fftsize):
+    ''' Returns a 24-by-(1+fftsize/2) float matrix that, dotted with an rfft amplitude spectrum,
+        gives the average amplitude per Bark band.  Works on a (windows, buckets) batch too, via amps.dot(matrix.T).
+
+        Each row has 1/count at the buckets that fall into that band, so this is the same as doing
+          amp[barkbuckets==band].sum()/count   for each band,  without the per-band mask scans.
+
+        Bands that no FFT bucket falls into (happens at small fftsize) are all-zero rows.
+
+        Cached, because there are only a handful of distinct (sample_rate, fftsize) combinations.
+    '''
+    key = (sample_rate, fftsize)
+    if key in _bmcache:
+        return _bmcache[key]
+
+    bucketsize      = int( 1+fftsize/2 )
+    approx_width_hz = float( sample_rate/2. )/float( fftsize/2 )
+    barkbuckets     = numpy.zeros(bucketsize, dtype=numpy.uint8)
+    for fi in range(bucketsize):
+        barkbuckets[fi] = bark( (0.5+fi)*approx_width_hz )
+
+    counts = numpy.bincount(barkbuckets, minlength=24)[:24]
+    ret = numpy.zeros( (24,bucketsize), dtype=numpy.float64 )
+    ret[barkbuckets, numpy.arange(bucketsize)] = 1.
+    nonempty = counts>0
+    ret[nonempty] /= counts[nonempty][:,numpy.newaxis]
+
+    _bmcache[key] = ret
+    return ret
+
+
 
 #### Decoding and helpers ##########################
 
@@ -122,30 +155,252 @@ def covering_windows(ary,  window_size,  min_overlap):
     if w < window_size: # TODO: think about this more.
         yield ary
     else:
-        fmi = float(min_overlap)
-        if fmi>0.0 and fmi<1.0:
-            min_overlap = int(math.ceil(fmi*window_size))
-            #print "min_overlap from float (%.3f * %d) means %d "%(fmi, window_size, min_overlap)
-        # brute force this, I'm too lazy to think about it right now - though I expect it's just a sub and div. Ahem :)
-        wsteps = None
-        for numsteps in range( int( max(2,w / window_size)), int(w/2) ): # sane limits
-            st = numpy.linspace( window_size, w, numsteps )
-            stepsize = st[1]-st[0]
-            overlap = window_size-stepsize
-            if overlap >= min_overlap:
-                #print "Dividing width %s into %d steps (stepsize is %.1f) gives %.1f overlap"%(w,numsteps,  stepsize,overlap)
-                wsteps = numsteps
-                break
-        for xoff in numpy.linspace(0, w-window_size, wsteps):
-            fromx = int(xoff)
-            tox   = int(math.floor(fromx+window_size))
-            #print 'x',xoff, ' ', fromx, '..', tox, tox-fromx
-            yield ary[fromx:tox]
-
-
-class DecodeError(Exception):
-    ' custom exception, primarily for readability'
-    pass
+        for fromx in window_offsets(w, window_size, min_overlap):
+            yield ary[fromx:fromx+window_size]
+
+
+def window_offsets(w, window_size, min_overlap):
+    ''' The start offsets that covering_windows() uses for an array of length w (which must be >= window_size),
+        as a numpy int array.  See covering_windows for what min_overlap means.
+
+        The smallest step count that gives at least min_overlap is just a sub and a div:
+        n steps over the  w-window_size  span are  span/(n-1)  apart,  which must be at most  window_size-min_overlap.
+        Offsets are calculated in integers, so they are exact rather than truncated floats.
+    '''
+    fmi = float(min_overlap)
+    if fmi>0.0 and fmi<1.0:
+        min_overlap = int(math.ceil(fmi*window_size))
+        #print "min_overlap from float (%.3f * %d) means %d "%(fmi, window_size, min_overlap)
+    span    = w - window_size
+    maxstep = window_size - min_overlap
+    if span == 0:
+        wsteps = 1
+    elif maxstep <= 0:
+        raise ValueError('min_overlap (%s) must be smaller than window_size (%s)'%(min_overlap, window_size))
+    elif isinstance(maxstep, int):
+        wsteps = 1 + (-(-span // maxstep)) # integer ceil
+    else:
+        wsteps = 1 + int(math.ceil( span / maxstep ))
+    wsteps = max( wsteps, 2, int(w / window_size) )
+    return (numpy.arange(wsteps) * span) // (wsteps-1)
+
+
+def counting(chunk_gen, counter):
+    ''' Passes through an iterable of sample arrays, adding up their lengths in counter['samples'] as they go by '''
+    for chunk in chunk_gen:
+        counter['samples'] += len(chunk)
+        yield chunk
+
+
+def fixed_hop_frames(chunk_gen, fftsize, hop):
+    ''' The alternative to fitting windows into each chunk: frame a whole stream with one fixed hop,
+        regardless of how it was chunked, so all frames overlap the same amount.
+
+        Takes an iterable of 1D sample arrays (of any size),
+        yields (starts, frames) tuples, with
+        - starts: each frame's absolute sample position in the stream
+        - frames: a (numframes, fftsize) read-only strided view, which is only valid until the next iteration
+        If the end of the stream has samples not covered by a full frame, they become one last zero-padded frame.
+    '''
+    carry    = None
+    carrypos = 0 # absolute sample position of carry[0]
+    for chunk in chunk_gen:
+        if carry is None or len(carry)==0:
+            buf = chunk
+        else:
+            buf = numpy.concatenate( (carry, chunk) )
+        numframes = 0
+        if len(buf) >= fftsize:
+            numframes = 1 + (len(buf)-fftsize)//hop
+            view = numpy.lib.stride_tricks.sliding_window_view(buf, fftsize)[::hop]
+            yield carrypos + hop*numpy.arange(numframes), view[:numframes]
+        carry     = buf[numframes*hop:]
+        carrypos += numframes*hop
+
+    if carry is not None and len(carry) > fftsize-hop: # otherwise the last full frame already covered those
+        frame = numpy.zeros( (1,fftsize), dtype=carry.dtype )
+        frame[0,:len(carry)] = carry
+        yield numpy.array([carrypos]), frame
+
+
+def framed_windows(ary, window_size, min_overlap):
+    ''' The same windows as covering_windows(), but all at once as a (numwindows, window_size) array,
+        gathered from a strided view, so that the window function and FFT can each be done in one call.
+
+        The result is a copy, so is safe to modify in-place.
+        Input shorter than window_size becomes a single zero-padded window.
+    '''
+    w, = ary.shape
+    if w < window_size:
+        ret = numpy.zeros( (1,window_size), dtype=ary.dtype )
+        ret[0,:w] = ary
+        return ret
+    view = numpy.lib.stride_tricks.sliding_window_view(ary, window_size)
+    return view[ window_offsets(w, window_size, min_overlap) ]
+
+
+def frame_bark_bands(frames, plan):
+    ''' Takes a (numframes, fftsize) array of samples,
+        applies the window function and does the rfft for all frames in one go,
+        returns a (numframes, 24) array of Bark band amplitudes.   Does not modify frames.
+    '''
+    amps = numpy.abs( numpy.fft.rfft(frames*plan.window, axis=-1) ) # amplitude spectrum
+    #pwr = amps**2  # PSD gives more contrasty spectrograms, but I like there being more to color.
+    amps /= plan.fftsize  # normalize
+    return amps.dot( plan.bandmatrix.T )
+
+
+def chunk_bark_bands(framelist, plan):
+    ''' Takes a list of per-chunk windows (each a (numwindows, fftsize) array, e.g. from AnalysisPlan.frames),
+        and returns a (len(framelist), 24) array: per chunk, the Bark band amplitudes averaged over its windows.
+        All windows go through frame_bark_bands at once.
+    '''
+    counts = numpy.array( list(frames.shape[0]  for frames in framelist) )
+    if len(framelist)==1:
+        frames = framelist[0]
+    else:
+        frames = numpy.concatenate( framelist )
+    bands  = frame_bark_bands(frames, plan)
+    starts = numpy.concatenate( ([0], numpy.cumsum(counts)[:-1]) )
+    return numpy.add.reduceat(bands, starts, axis=0) / counts[:,numpy.newaxis]
+
+
+def bin_averages(sums, counts):
+    ''' Given per-bin sums of per-frame band values (numbins, 24) and how many frames went into each bin,
+        returns the per-bin averages.
+        Bins that no frame landed in (when bins are shorter than the hop) take the value of the nearest bin that did.
+    '''
+    ret = numpy.zeros( sums.shape, dtype=numpy.float64 )
+    filled = numpy.flatnonzero(counts)
+    if len(filled)==0:
+        return ret
+    ret[filled] = sums[filled] / counts[filled][:,numpy.newaxis]
+    empty = numpy.flatnonzero(counts==0)
+    if len(empty) > 0:
+        right = numpy.clip( numpy.searchsorted(filled, empty), 0, len(filled)-1 )
+        left  = numpy.clip( right-1, 0, len(filled)-1 )
+        nearest = numpy.where( numpy.abs(filled[left]-empty) <= numpy.abs(filled[right]-empty),  filled[left], filled[right] )
+        ret[empty] = ret[nearest]
+    return ret
+
+
+class BandAccumulator(object):
+    ''' Collects per-frame band values while streaming, for when the total length isn't known until the end,
+        and folds them into a fixed number of bins (by sample position) once it is.
+
+        Frames are summed into blocks of block_samples each.
+        When a frame lands beyond maxblocks blocks, neighbouring blocks are merged pairwise and block_samples doubles,
+        so memory stays at maxblocks rows however long the stream is,
+        while there are still at least maxblocks/2 blocks to fold into the output bins.
+
+        Each block also remembers the average position of its frames, so that folding is exact for as long as blocks are single frames.
+    '''
+    def __init__(self, block_samples, maxblocks=8192, numbands=24):
+        self.block_samples = block_samples
+        self.maxblocks     = maxblocks
+        self.sums      = numpy.zeros( (maxblocks, numbands), dtype=numpy.float64 )
+        self.possums   = numpy.zeros( maxblocks, dtype=numpy.float64 )
+        self.counts    = numpy.zeros( maxblocks, dtype=numpy.intp )
+
+    def _merge_pairs(self):
+        half = self.maxblocks//2
+        for ary in (self.sums, self.possums, self.counts):
+            ary[:half] = ary.reshape( (half,2)+ary.shape[1:] ).sum(axis=1)
+            ary[half:] = 0
+        self.block_samples *= 2
+
+    def add(self, positions, bands):
+        ''' positions: sample position of each frame (probably its center),  bands: (numframes, numbands) '''
+        while positions[-1]//self.block_samples >= self.maxblocks:
+            self._merge_pairs()
+        blocks = positions // self.block_samples
+        numpy.add.at( self.sums, blocks, bands )
+        self.possums += numpy.bincount( blocks, weights=positions, minlength=self.maxblocks )
+        self.counts  += numpy.bincount( blocks, minlength=self.maxblocks )
+
+    def fold(self, nsamples, numbins=1000):
+        ''' Returns (numbins, numbands) averages, for a stream that turned out to be nsamples long '''
+        filled = numpy.flatnonzero(self.counts)
+        binsums   = numpy.zeros( (numbins, self.sums.shape[1]), dtype=numpy.float64 )
+        bincounts = numpy.zeros( numbins, dtype=numpy.intp )
+        if len(filled) > 0:
+            meanpos = self.possums[filled] / self.counts[filled]
+            bins = numpy.clip( (meanpos*numbins/nsamples).astype(numpy.intp), 0, numbins-1 )
+            numpy.add.at( binsums, bins, self.sums[filled] )
+            numpy.add.at( bincounts, bins, self.counts[filled] )
+        return bin_averages(binsums, bincounts)
+
+
+class AnalysisPlan(object):
+    ''' Everything make_mood needs per chunk that depends only on  (sample_rate, fftsize, overlap, chunk length),
+        so that it is worked out once instead of for each of the 1000 chunks.
+        Get these via analysis_plan(), which caches them.
+
+        - window:         the window function, fftsize long, times scale (which is how we bring other sample formats to 16-bit scale)
+        - bandmatrix:     averages FFT buckets into Bark bands, see bark_band_matrix()
+        - factoradjusts:  dB(B) factor per FFT bucket  (not currently applied to anything)
+        - offsets:        window start offsets within a chunk, see window_offsets()
+                          (None if the chunk is shorter than a window, or chunk_samples is None for fixed-hop use)
+        - hop:            frame step when not fitting windows into chunks, see fixed_hop_frames()
+    '''
+    def __init__(self, sample_rate, fftsize, overlap, chunk_samples, scale=1.):
+        self.sample_rate   = sample_rate
+        self.fftsize       = fftsize
+        self.overlap       = overlap
+        self.chunk_samples = chunk_samples
+        self.scale         = scale
+
+        bucketsize      = int( 1+fftsize/2 )
+        approx_width_hz = float( sample_rate/2. )/float( fftsize/2 )
+        self.factoradjusts = numpy.zeros(bucketsize, dtype=numpy.float32)
+        for fi in range(bucketsize):
+            self.factoradjusts[fi] = dbb_factor( (0.5+fi)*approx_width_hz )
+
+        self.window     = hanning(fftsize) * scale
+        self.bandmatrix = bark_band_matrix(sample_rate, fftsize)
+        self.hop        = fftsize - overlap
+        self.offsets    = None
+        if chunk_samples is not None and chunk_samples >= fftsize:
+            self.offsets = window_offsets(chunk_samples, fftsize, overlap)
+
+    def frames(self, chunksamples):
+        ''' framed_windows() for a chunk of this plan's length, using the precalculated offsets '''
+        if self.offsets is None:
+            return framed_windows(chunksamples, self.fftsize, self.overlap)
+        view = numpy.lib.stride_tricks.sliding_window_view(chunksamples, self.fftsize)
+        return view[ self.offsets ]
+
+
+@functools.lru_cache(maxsize=64)
+def analysis_plan(sample_rate, fftsize, overlap, chunk_samples, scale=1.):
+    ''' Returns an AnalysisPlan for these parameters.
+        Memoized (per process) - a track typically needs one for its regular chunks and one for its shorter last chunk,
+        and a batch run only sees a few distinct fftsizes, so the bounded cache mostly hits.
+    '''
+    return AnalysisPlan(sample_rate, fftsize, overlap, chunk_samples, scale)
+
+
+DecodeError = helpers_ffmpeg.DecodeError  # what decoders raise when failing partway, see there
+
+
+def tolerating_end(chunk_gen, estlength_sec, tolerance_sec=3., say=print):
+    ''' Passes through a decoder's chunks, except that a DecodeError within tolerance_sec of the estimated length
+        just ends the stream (so the caller finishes normally, with what it got).
+        That is mostly junk after the audio, like the APEv2 tag mp3gain adds, which isn't valid frame data.
+        Without an estimate (single pass) there is nothing to compare with, so the error goes through.
+        say is what we mention that with.
+    '''
+    try:
+        for chunk in chunk_gen:
+            yield chunk
+    except DecodeError as e:
+        if estlength_sec is None or e.seconds is None:
+            raise
+        diffsec = abs(e.seconds - estlength_sec)
+        if diffsec > tolerance_sec:
+            say( "Decode before end, difference is %.2f seconds"%diffsec)
+            raise
+        say( "Decode error at end (%.1f sec difference to estimated length) - small difference, probably something like stray APEv2, fine."%diffsec )
 
 ###
 _hcache = {}
@@ -159,13 +414,13 @@ def hanning(size):
         return ret
 
 
-def make_mood(mediafilename): # , debug=False
+def make_mood(mediafilename, windowing='fit', probe_length=True, sample_format='f32le', decoder=None, info=None, say=print): # , debug=False
     '''Given a media filename (probably mp3, ogg, or such) 
 
        What it does:
-       - get length   (using ffprobe) (to be able to do the second point and third points streaming-style)
+       - get length   (using ffprobe, or the in-process decoder) (to be able to do the second point and third points streaming-style)
        - split into 1000 equal-sized chunks
-       - stream-decode file  (using ffmpeg)   (should take ~1sec of CPU  per 4MB of MP4)
+       - stream-decode file  (using ffmpeg, or PyAV/soundfile if installed)   (should take ~1sec of CPU  per 4MB of MP4)
        - FFT each chunk
        - reweigh buckets for human perception:
          - sum into Bark buckets (so non-linear)
@@ -177,6 +432,30 @@ def make_mood(mediafilename): # , debug=False
          (You could save these to binary data with ary.tostring())
        ...or None,None if it decides it can't.
 
+       windowing controls how FFT windows are laid over the audio:
+       - 'fit'    fits windows into each 1000th-length chunk (see covering_windows), so overlap varies a little per track.
+       - 'fixed'  frames the whole stream with one fixed hop, and assigns each frame to a 1000th by the exact sample position of its center.
+
+       probe_length=False skips the ffprobe step and does everything in the one decoding pass:
+       it implies 'fixed' windowing (and the fftsize for 'most cases'), collects frames at a fine resolution while decoding,
+       and only divides them into 1000ths once it knows the actual amount of samples.
+       Saves a process and a file open, and the length isn't an estimate.
+
+       decoder picks the decoding backend by name (see helpers_ffmpeg.open_decoder), default is the best one installed.
+       With an in-process one, the length comes from the file itself rather than an ffprobe process.
+
+       sample_format is what we ask the decoder for (see helpers_ffmpeg.SAMPLE_FORMATS).
+       The default f32le skips 16-bit quantization (and clipping) between resampling and FFT.
+       Amplitudes are brought to 16-bit scale either way (via the window function), so the output is comparable.
+
+       info, if you pass in a dict, gets
+       - 'seconds': the length of the audio as decoded (for throughput reporting and such).
+       - 'raw_bark': the 24x1000 float32 bark-band sums before bark_to_mood, e.g. for write_bark
+       - 'failure': (reason, detail) when we return None,None
+       - 'decoded_seconds': how far we got, when decoding raised an error
+
+       say is what the odd remark gets printed with, e.g. something that collects them, when stdout isn't ours to write to.
+
        TODO:
        - optimize, once I've played with and settled on all the weighing
        - deal better with few-second files
@@ -185,12 +464,24 @@ def make_mood(mediafilename): # , debug=False
     # TODO: figure out cost/benefit against FFT speed  (resampling to 22050 adds maybe 30% on top of decode calculations.)
     # TODO: see if ffmpeg can output arbitrary sample rates
 
-    estlength_sec = helpers_ffmpeg.get_length(mediafilename)#, decode=False)
-    nsamples = estlength_sec * sample_rate
+    audio = helpers_ffmpeg.open_decoder(mediafilename, sample_rate, sample_format=sample_format, backend=decoder)
+    if probe_length:
+        estlength_sec = audio.duration()
+        nsamples = estlength_sec * sample_rate
+    else:
+        estlength_sec = None
+        nsamples      = None
+        windowing     = 'fixed'
     # Note that since our use is just Bark bands, we can get away with 1024 or 2048
 
     #fudge things for very short media
-    if nsamples < 128000:    # ..5sec
+    if nsamples is None: # don't know yet, assume most cases. (too-short check happens after decoding)
+        overlapsize = 64
+        fftsize     = 1024
+    elif nsamples < 128000:    # ..5sec
+        audio.close()
+        if info is not None:
+            info['failure'] = ('too short', '%.1f sec according to %s'%(estlength_sec, audio.name))
         return None,None
         #overlapsize = 8
         #fftsize     = 64
@@ -207,77 +498,83 @@ def make_mood(mediafilename): # , debug=False
         overlapsize = 64
         fftsize     = 1024
 
-    bucketsize  = int( 1+fftsize/2 )
-
-    chunklen_samples = int( nsamples / 1000. )
-    # note: int will truncate so this will add up time-error-wise. right now I choose not to care, but
-    # TODO: rewrite the logic to care.
+    if nsamples is not None:
+        chunklen_samples = int( nsamples / 1000. )
+        # note: int will truncate so this will add up time-error-wise. right now I choose not to care, but
+        # TODO: rewrite the logic to care.   (or use windowing='fixed', which doesn't have this problem)
 
     #print( 'Length estimate (ffprobe): ~%.3f seconds, ~%d samples'%( estlength_sec, nsamples) )
     #print( "Which would be ~%d samples @ %dHz"%(estlength_sec * sample_rate, sample_rate) )
     #print( "Each 1/1000-length chunk is ~%d samples"%(chunklen_samples) )
 
+    # the weighing below was tuned on 16-bit-scale amplitudes
+    scale = 32768. / helpers_ffmpeg.SAMPLE_FORMATS[sample_format][1]
+
     # our first goal is to sum into bark-bands per 1000th-length segment
     bark_ary = numpy.zeros( (24,1000), dtype=numpy.float32 )
+    samplepos = 0 # keep track of how much data we saw
+    seen = {'samples':0}
     try:
-        chunksample_gen = helpers_ffmpeg.stream_audio(mediafilename, sample_rate, chunk_samples=chunklen_samples)  # generator
-
-        samplepos = 0 # keep track of how much data we saw
-        for i, chunksamples in enumerate(chunksample_gen):
-            if i==1000: # TODO: remove the need for this? (it's because we under-read a little, see chunklen_samples)
-                break
-            if len(chunksamples)==0: # TODO: remove the need for this?
-                break
-            #print( "chunk %s gets samples %d..%d (of %d)"%(i, samplepos, samplepos+len(chunksamples), nsamples,) ) # for debug of that time error
-
-            samplepos += chunksamples.shape[0]
-
-            #at_seconds = float(samplepos) / sample_rate
-            #sys.stdout.write( "at %dm%02ds (of ~%dm%02ds)  in %r\n"%(  at_seconds/60, at_seconds%60,  estlength_sec/60, estlength_sec%60,    os.path.basename(mediafilename)   ))
-            #sys.stdout.flush()
-
-            # constants given the above
-            approx_width_hz = float( sample_rate/2. )/float( fftsize/2 )
-            barkbuckets     = numpy.zeros(bucketsize, dtype=numpy.uint8)
-            factoradjusts   = numpy.zeros(bucketsize, dtype=numpy.float32)
-            for fi in range(bucketsize):
-                approx_center     = (0.5+fi)*approx_width_hz
-                barkbuckets[fi]   = bark(approx_center)
-                factoradjusts[fi] = dbb_factor( approx_center )
-
-            for windowsamples in covering_windows(chunksamples, fftsize, overlapsize):
-                #if len(windowsamples)==0: # TODO: remove the need. This shouldn't happen?
-                #    raise ValueError('bug in code, covering_windows outputted something %d long'%len(windowsamples))
-                # TODO: pad if smaller because we baked in size assumptions - length of the last chunk will typically be shorter
-                windowsamples *= hanning( len(windowsamples) )
-                #print( "chunk %d window %d: %d samples"%(i,wi, len(windowsamples)) )
-                ft = numpy.fft.rfft( windowsamples )
-                amp = numpy.abs( ft ) # amplitude spectrum
-                #pwr = amp**2  # PSD gives more contrasty spectrograms, but I like there being more to color.
-                amp /= fftsize  # normalize
-                # reminder: bark_ary is a 24-by-1000-sized thing,
-                #           amp is 1+fftsize/2 sized to be mapped into 24 via barkbuckets,  and summed into bark_ary
-                #barkbuckets looks something like 0 0 0 0 0 1 1 1 1 2 2 2 2 3 3 3 3 3 4 4 4 4 4 5 5 5 5 5 6 6 6 6 6 6 6
-                #                                 7 7 7 7 7 7 8 8 8 8 8 8 8 8 9 9 9 9 9 9 9 9 9 etc
-                # so this, while not the most efficient, is understandable and brief
-                values, counts = numpy.unique(barkbuckets, return_counts=True)
-                for bbuck,cnt in zip( list(values), list(counts) ):
-                    try:
-                        bark_ary[bbuck][i] = amp[barkbuckets==bbuck].sum()/cnt
-                    except Exception as e:
-                        pass
-        for dump in chunksample_gen: # TODO: remove the need
-            pass
-
-    except DecodeError: # ...this no longer looks right, TODO: look
-        at_seconds = float(samplepos) / sample_rate
-        #print( "Decode error at %dm%02ds (of %dm%02ds)"%(at_seconds/60, at_seconds%60,  estlength_sec/60, estlength_sec%60) )
-        diffsec = abs(at_seconds-estlength_sec)
-        if diffsec > 3:
-            print( "Decode before end, difference is %.2f seconds"%diffsec)
-            raise
+        if windowing == 'fixed':
+            plan = analysis_plan(sample_rate, fftsize, overlapsize, None, scale)
+            # recycle=2 is safe because fixed_hop_frames only holds on to (the tail of) the previous chunk
+            chunksample_gen = tolerating_end( audio.chunks(sample_rate, recycle=2), estlength_sec, say=say )  # generator
+            acc = BandAccumulator( plan.hop )
+            for starts, frames in fixed_hop_frames(counting(chunksample_gen, seen), fftsize, plan.hop):
+                # position each frame by its center
+                acc.add( starts + fftsize//2, frame_bark_bands(frames, plan) )
+            samplepos = seen['samples']
+            if nsamples is None and samplepos < 128000: # ..5sec, see above
+                if info is not None:
+                    info['failure'] = ('too short', '%.1f sec decoded'%(float(samplepos)/sample_rate))
+                return None,None
+            bark_ary[:] = acc.fold( samplepos ).T
+
         else:
-            print( "Decode error at end (%.1f sec difference to estimated length) - small difference, probably something like stray APEv2, fine."%diffsec )
+            chunksample_gen = tolerating_end( audio.chunks(chunklen_samples, recycle=2), estlength_sec, say=say )  # generator
+
+            batch_windows = 512
+            pending_frames, pending_chunks, pending_count = [], [], 0
+            for i, chunksamples in enumerate(chunksample_gen):
+                if i==1000: # TODO: remove the need for this? (it's because we under-read a little, see chunklen_samples)
+                    break
+                if len(chunksamples)==0: # TODO: remove the need for this?
+                    break
+                #print( "chunk %s gets samples %d..%d (of %d)"%(i, samplepos, samplepos+len(chunksamples), nsamples,) ) # for debug of that time error
+
+                samplepos += chunksamples.shape[0]
+
+                #at_seconds = float(samplepos) / sample_rate
+                #sys.stdout.write( "at %dm%02ds (of ~%dm%02ds)  in %r\n"%(  at_seconds/60, at_seconds%60,  estlength_sec/60, estlength_sec%60,    os.path.basename(mediafilename)   ))
+                #sys.stdout.flush()
+
+                # gather windows from a few chunks so that the FFT gets decently sized batches,
+                # which matters most for short files, which have few windows per chunk
+                plan = analysis_plan(sample_rate, fftsize, overlapsize, chunksamples.shape[0], scale)
+                pending_frames.append( plan.frames(chunksamples) )
+                pending_chunks.append( i )
+                pending_count += pending_frames[-1].shape[0]
+                if pending_count >= batch_windows:
+                    # reminder: bark_ary is a 24-by-1000-sized thing
+                    bark_ary[:,pending_chunks] = chunk_bark_bands(pending_frames, plan).T
+                    pending_frames, pending_chunks, pending_count = [], [], 0
+
+            if len(pending_frames) > 0:
+                bark_ary[:,pending_chunks] = chunk_bark_bands(pending_frames, plan).T
+
+            for dump in chunksample_gen: # TODO: remove the need
+                pass
+
+    except ValueError as e: # the decoders' way of saying they failed (near-the-end DecodeErrors were let go by tolerating_end).
+        # Note where, for whoever wants to remember this file as broken
+        if info is not None:
+            info['decoded_seconds'] = getattr(e, 'seconds', None)
+            if info['decoded_seconds'] is None:
+                info['decoded_seconds'] = float( max(samplepos, seen['samples']) ) / sample_rate
+        raise
+
+    if info is not None:
+        info['seconds'] = float(samplepos) / sample_rate
 
     # CONSIDER: a fixed-dB range instead of either of these.
 
@@ -286,6 +583,20 @@ def make_mood(mediafilename): # , debug=False
     #plt.imshow(bark_ary, cmap='gray', vmin=0, vmax=255)
     #plt.show()
 
+    if info is not None:
+        info['raw_bark'] = bark_ary.copy()
+
+    return bark_to_mood(bark_ary)
+
+
+def bark_to_mood(bark_ary):
+    ''' The part of make_mood after the analysis: from the raw 24x1000 float bark-band sums,
+        the moodbar colors, and a tweaked-for-display spectrogram.
+        Separate so that a stored raw matrix (see write_bark) can be re-rendered without decoding again.
+        Returns what make_mood does (1000x24 and 1000x3 uint8).
+    '''
+    bark_ary = numpy.array(bark_ary, dtype=numpy.float32) # a copy, since the below works partly in-place
+
     ### Generating a more classic RGB moodbar just means summing 24 bark_ary rows into 3 somehow.
     # there's a shorter way of doing this, which I'll do when I'm done tweaking
     colorweight = (5.0, 5.0, 4.0, 3.0,                               # lo  (red)
@@ -341,13 +652,118 @@ def make_mood(mediafilename): # , debug=False
 
 
 def read_mood(filename):
-    ''' Reads a .mood file into one flat array, which will probably be 3000 items long '''
-    #stob = os.stat(filename)
-    f = open(filename,'rb')
-    data = f.read()
-    data = array.array('B',data).tolist()
-    f.close()
-    return data
+    ''' Reads a .mood file into a (samples,3) uint8 array (r,g,b per row), which will probably be 1000 rows.
+        (A trailing partial triple, which shouldn't happen, is ignored)
+    '''
+    with open(filename,'rb') as f:
+        data = f.read()
+    data = numpy.frombuffer(data, dtype=numpy.uint8)
+    return data[:len(data)-len(data)%3].reshape(-1,3)
+
+
+### .bark sidecar: the bark matrix, so that images can be re-rendered (or re-tweaked) without decoding the audio again
+#  b'BARK', version, number of sections,   then per section a header and rows*cols values, row-major:
+#  - 'raw32', 'raw16', 'raw8'   the float bark-band sums before bark_to_mood, (24 bands, 1000 steps), 
+#                               as float32, float16, or uint8 quantized between the min and max
+#  - 'final'                    what make_mood returns for the bark bands, uint8 (1000 steps, 24 bands). Needs the .mood for colors.
+BARK_FORMATS    = ('raw32', 'raw16', 'raw8', 'final')
+_bark_head      = struct.Struct('<4sBB')
+_bark_section   = struct.Struct('<BBHIff')   # format index, reserved, rows, cols, offset, scale
+_bark_dtypes    = {'raw32':numpy.float32, 'raw16':numpy.float16, 'raw8':numpy.uint8, 'final':numpy.uint8}
+
+
+def bark_bytes(raw=None, final=None, formats=('raw16',)):
+    ''' The contents of a .bark file, holding the given formats (see BARK_FORMATS) of
+        raw (the 24x1000 float32 from make_mood's info['raw_bark']) and/or final (the 1000x24 uint8 make_mood returns)
+    '''
+    parts = [ _bark_head.pack(b'BARK', 1, len(formats)) ]
+    for fmt in formats:
+        if fmt not in BARK_FORMATS:
+            raise ValueError('Unknown .bark format %r, we know of %s'%(fmt, ', '.join(BARK_FORMATS)))
+        ary = final  if fmt == 'final' else  raw
+        if ary is None:
+            raise ValueError('.bark format %r needs the %s matrix'%(fmt, 'final' if fmt == 'final' else 'raw'))
+        ary = numpy.asarray(ary, dtype=numpy.float32)
+        offset, scale = 0., 1.
+        if fmt == 'raw8':
+            offset = float(ary.min())
+            scale  = max( float(ary.max()) - offset, 1e-6 ) / 255.
+            ary    = numpy.round( (ary - offset) / scale )
+        elif fmt == 'raw16':                          # keep within float16 range (65504)
+            scale  = max( 1., float(numpy.abs(ary).max()) / 60000. )
+            ary    = ary / scale
+        data = ary.astype( numpy.dtype(_bark_dtypes[fmt]).newbyteorder('<') )
+        parts.append( _bark_section.pack(BARK_FORMATS.index(fmt), 0, data.shape[0], data.shape[1], offset, scale) )
+        parts.append( data.tobytes() )
+    return b''.join(parts)
+
+
+def read_bark(filename):
+    ''' Reads a .bark file, returns a dict with
+        'raw' (24x1000 float32, from whichever raw format it has, most precise first) and/or 'final' (1000x24 uint8)
+    '''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if len(data) < _bark_head.size:
+        raise ValueError('Not a .bark file: %r'%filename)
+    magic, version, nsections = _bark_head.unpack_from(data, 0)
+    if magic != b'BARK':
+        raise ValueError('Not a .bark file: %r'%filename)
+    if version != 1:
+        raise ValueError('.bark version %d is newer than we know: %r'%(version, filename))
+    pos, found = _bark_head.size, {}
+    for _ in range(nsections):
+        fmtidx, _, rows, cols, offset, scale = _bark_section.unpack_from(data, pos)
+        pos += _bark_section.size
+        fmt   = BARK_FORMATS[fmtidx]
+        dtype = numpy.dtype(_bark_dtypes[fmt]).newbyteorder('<')
+        nbytes = rows * cols * dtype.itemsize
+        if pos + nbytes > len(data):
+            raise ValueError('Truncated .bark file: %r'%filename)
+        ary = numpy.frombuffer(data, dtype=dtype, count=rows*cols, offset=pos).reshape(rows, cols)
+        pos += nbytes
+        if fmt == 'final':
+            found['final'] = ary.astype(numpy.uint8)
+        else:
+            found[fmt] = ary.astype(numpy.float32) * scale + offset
+    ret = {}
+    for fmt in ('raw32', 'raw16', 'raw8'):
+        if fmt in found:
+            ret['raw'] = found[fmt]
+            break
+    if 'final' in found:
+        ret['final'] = found['final']
+    return ret
+
+
+def bark_image(filename, width=None, height=None, mood_filename=None):
+    ''' Renders a .bark file to the same image moodbar-generate writes as .mood.png (see fancy_image), without touching the audio.
+        From a raw matrix this redoes bark_to_mood (so it follows changes there);
+        from just a final one it needs the colors from the .mood (mood_filename, default is the .bark's name with .mood)
+    '''
+    bark = read_bark(filename)
+    if 'raw' in bark:
+        barkary, moodary = bark_to_mood( bark['raw'] )
+    elif 'final' in bark:
+        if mood_filename is None:
+            mood_filename = filename.rsplit('.',1)[0] + '.mood'
+        barkary, moodary = bark['final'], read_mood(mood_filename)
+    else:
+        raise ValueError('Nothing we can render in %r'%filename)
+    return fancy_image(barkary, moodary, width=width, height=height)
+
+
+_gamma_lut = None
+def gamma_lut():
+    ''' (3,256) uint8 table of the gamma curves mood_image applies per channel,
+        computed the way it was per pixel (so lookups give the same values), and only once.
+    '''
+    global _gamma_lut
+    if _gamma_lut is None:
+        oo256 = 1./256.
+        _gamma_lut = numpy.array( [ [ int( ((v*oo256)**gamma)*255 )   for v in range(256) ]
+                                    for gamma in (0.57, 1.2, 1.2) ], dtype=numpy.uint8 )
+    return _gamma_lut
 
 
 def mood_image(filename, height=20, width=None):
@@ -362,28 +778,17 @@ def mood_image(filename, height=20, width=None):
     '''
     from PIL import Image, ImageFilter
     data = read_mood(filename)
-    oo256 = 1./256.
-    numsamples = int(len(data)/3)
-    img = Image.new('RGB',(numsamples,1) )
-    for i in range(0,len(data),3):
-        r,g,b = data[i:i+3]
-        r = int( ((r*oo256)**0.57)*255 )
-        g = int( ((g*oo256)**1.2)*255 )
-        b = int( ((b*oo256)**1.2)*255 )
-        img.putpixel( (int(i/3),0), (r,g,b)  )
-    newsize = list(img.size)
-    if height:
-        newsize[1]=height
-    if width:
-        newsize[0]=width
-    newsize = tuple(newsize)
-    if img.size != newsize:
-        #print newsize
-        if newsize[0] < 1000: # if scaling down, blur first. CONSIDER: do this in other methods too?
-            #print "BLUR %.2f"%(1000./newsize[0])
-            img = img.filter( ImageFilter.BoxBlur( 300./newsize[0] ) )
-        img = img.resize( newsize )
-    return img
+    lut  = gamma_lut()
+    row  = numpy.stack( [lut[0][data[:,0]], lut[1][data[:,1]], lut[2][data[:,2]]], axis=1 ) # (samples,3)
+    numsamples = len(row)
+    if not width or width == numsamples: # only stretching vertically, which is just repeating the row
+        return Image.fromarray( numpy.ascontiguousarray( numpy.broadcast_to(row, (height or 1, numsamples, 3)) ), 'RGB' )
+
+    img = Image.fromarray( row[None,:,:], 'RGB' )
+    newsize = (width, height or 1)
+    if newsize[0] < 1000: # if scaling down, blur first. CONSIDER: do this in other methods too?
+        img = img.filter( ImageFilter.BoxBlur( 300./newsize[0] ) )
+    return img.resize( newsize )
 
 
 def mood_image3(filename, height=21, width=None):
@@ -392,15 +797,11 @@ def mood_image3(filename, height=21, width=None):
     from PIL import Image#, ImageFilter
     # could play with things like horizonal median?
     data = read_mood(filename)
-    #oo256 = 1./256.
-
-    numsamples = len(data)/3
-    img = Image.new('RGB',(numsamples,3) )
-    for i in range(0,len(data),3):
-        r,g,b = data[i:i+3]
-        img.putpixel( (i/3,0), (r,0,0)  )
-        img.putpixel( (i/3,1), (0,g,0)  )
-        img.putpixel( (i/3,2), (0,0,b)  )
+    numsamples = len(data)
+    bands = numpy.zeros( (3, numsamples, 3), dtype=numpy.uint8 )
+    for band in range(3): # top row red, then green, then blue
+        bands[band,:,band] = data[:,band]
+    img = Image.fromarray( bands, 'RGB' )
 
     newsize = list(img.size)
     if height:
@@ -413,26 +814,69 @@ def mood_image3(filename, height=21, width=None):
     return img
 
 
-def fancy_image(barkary, moodary):
+def resample_columns(ary, width, axis=1):
+    ''' Resizes ary along axis to width entries without PIL: narrowing averages each span of columns (like a box filter),
+        widening repeats columns.  Returns uint8, rounded.
+    '''
+    n = ary.shape[axis]
+    if n == width:
+        return ary
+    idx    = numpy.arange(width)
+    starts = (idx * n) // width
+    counts = numpy.maximum( 1, ((idx+1) * n) // width - starts )
+    sums   = numpy.add.reduceat( ary.astype(numpy.float32), starts, axis=axis ) # repeated starts give the one column, for widening
+    shape  = [1]*ary.ndim
+    shape[axis] = width
+    return ( sums / counts.reshape(shape) + 0.5 ).astype(numpy.uint8)
+
+
+def mood_rows(moods, width=None):
+    ''' mood_image's colors for many moods at once (arrays as from read_mood), as a (len(moods), width, 3) uint8 array.
+        width defaults to the first mood's length; moods of other lengths are resampled to fit, see resample_columns.
+    '''
+    if width is None:
+        width = len(moods[0])
+    lut = gamma_lut()
+    ret = numpy.empty( (len(moods), width, 3), dtype=numpy.uint8 )
+    bylength = {}
+    for i, mood in enumerate(moods):
+        bylength.setdefault(len(mood), []).append(i)
+    for length, which in bylength.items(): # in practice one group, of 1000
+        stack = numpy.stack( [moods[i] for i in which] )                                   # (n, length, 3)
+        colors = numpy.stack( [lut[0][stack[...,0]], lut[1][stack[...,1]], lut[2][stack[...,2]]], axis=-1 )
+        ret[which] = resample_columns(colors, width, axis=1)
+    return ret
+
+
+def fancy_image(barkary, moodary, width=None, height=None):
     ''' Own experiment mixing moodbar's colors with the bark spectrogram we made
         Takes the output pair from make_mood:
         - the 24-band bark version while we still have it,
         - the more typical 3-band one we could read later),
         (we could work from just barkary, as moodary is just weighed from it),
         uses both to make effectively is a mood-colored 1000x24px bark-spectrogram image 
+
+        width and height default to the array sizes (1000 and 24).
+        Other sizes pick the nearest time step and band for each pixel, instead of rendering and resizing.
     '''
     from PIL import Image
-    spe = Image.new('RGB',(1000,24) )
-    # color it like the standard moodbar, one color for each time interval.
-    for i in range(0,1000):
-        lo, mid, hi = moodary[i][0], moodary[i][1], moodary[i][2] # could be weighted from barkary
-        for bark in range(24):
-            val = barkary[i][bark]
-            fval = float(val)/256.
-            spe.putpixel( (i,23-bark),  #23-   puts low freqs at bottom, not top
-                          (int(lo*fval),int(hi*fval),int(mid*fval))  )
-                          # note this deviates from moodbar: here blue is mid, green is high
-    return spe
+    barkary = numpy.asarray(barkary)
+    moodary = numpy.asarray(moodary)
+    nsteps, nbands = barkary.shape
+    if width is None:
+        width = nsteps
+    if height is None:
+        height = nbands
+    cols = ( numpy.arange(width)  * nsteps ) // width
+    rows = nbands-1 - ( numpy.arange(height) * nbands ) // height   # nbands-1-   puts low freqs at bottom, not top
+
+    # color it like the standard moodbar, one color for each time interval,
+    #   note this deviates from moodbar: here blue is mid, green is high
+    colors = moodary[cols][:, [0,2,1]].astype(numpy.float64)            # (width, 3)
+    fval   = barkary[cols][:, rows].astype(numpy.float64) / 256.        # (width, height)
+    pixels = colors[:, None, :] * fval[:, :, None]                      # (width, height, 3)
+    # the float->uint8 cast truncates, like int() did when this was done per pixel
+    return Image.fromarray( numpy.ascontiguousarray( pixels.transpose(1,0,2) ).astype(numpy.uint8), 'RGB' )
 
 
 
@@ -0,0 +1,133 @@
+''' Progress reporting for batch runs (moodbar-generate -r, mood2png -r):
+    files done of total, audio processed, realtime factor, MB/s read, failures, and an ETA.
+
+    On a terminal it rewrites one line in place, otherwise (e.g. logging to a file) it prints a line every so often.
+'''
+import sys
+import time
+import threading
+
+import helpers_format
+import helpers_shellcolor as sc
+
+
+def nicetime(sec):
+    ' helpers_format.nicetimelength, without its column alignment '
+    return ' '.join( helpers_format.nicetimelength(sec).split() )
+
+
+class Progress(object):
+    ''' Counts what the caller tells it (totals as they become known, and each job as it finishes), and shows it.
+        Is thread-safe, since pool callbacks tend to run in their own thread.
+
+        ETA is based on bytes rather than file count, because file sizes vary a lot more than per-byte speed does.
+    '''
+    def __init__(self, stream=None, interval=None, unit='files', audio=True):
+        ''' interval is the minimum seconds between updates, default is 0.5 for a terminal and 30 otherwise
+            audio=False leaves out audio processed and realtime factor, for jobs that don't decode anything (e.g. rendering)
+        '''
+        if stream is None:
+            stream = sys.stdout
+        self.stream   = stream
+        self.tty      = hasattr(stream, 'isatty') and stream.isatty()
+        if interval is None:
+            interval = 0.5  if self.tty else  30.
+        self.interval = interval
+        self.unit     = unit
+        self.audio    = audio
+        self.lock     = threading.RLock()
+        self.cols     = None
+        if self.tty:
+            self.cols = sc.tty_size()['cols'] or 80
+
+        self.started     = time.time()
+        self.shown       = 0.    # when we last showed
+        self.onscreen    = False # whether there's a partial line of ours on the terminal
+
+        self.total_jobs  = 0
+        self.total_bytes = 0
+        self.total_final = False # False while e.g. the scan is still adding to the totals
+        self.done_jobs   = 0
+        self.done_bytes  = 0
+        self.done_audio  = 0.    # seconds of audio
+        self.failed      = 0
+
+    def set_total(self, jobs, nbytes, final=True):
+        with self.lock:
+            self.total_jobs, self.total_bytes, self.total_final = jobs, nbytes, final
+
+    def done(self, nbytes=0, audio_sec=0., failed=False):
+        ' register a finished job, and maybe update the display '
+        with self.lock:
+            self.done_jobs  += 1
+            self.done_bytes += nbytes
+            self.done_audio += audio_sec or 0.
+            if failed:
+                self.failed += 1
+        self.show()
+
+    def eta_sec(self):
+        ''' estimated seconds left, or None if we can't say yet '''
+        elapsed = time.time() - self.started
+        if self.done_bytes == 0 or elapsed <= 0:
+            return None
+        return max(0., self.total_bytes - self.done_bytes) / (self.done_bytes / elapsed)
+
+    def line(self, width=None):
+        ''' The status line. If width is given, leaves out the least interesting parts until it fits. '''
+        with self.lock:
+            elapsed = max(1e-6, time.time() - self.started)
+            more    = ''  if self.total_final else  '+'
+            parts = [ # (how much we want to keep it when short on width,  plain text,  color function)
+                ( 9, '%d/%d%s %s'%(self.done_jobs, self.total_jobs, more, self.unit),                 sc.white ),
+            ]
+            if self.audio:
+                parts.append( ( 3, '%s audio'%nicetime(self.done_audio),                                None ) )
+                parts.append( ( 5, '%.0fx realtime'%(self.done_audio / elapsed),                         None ) )
+            else:
+                parts.append( ( 5, '%.0f %s/s'%(self.done_jobs / elapsed, self.unit),                    None ) )
+            parts.append(     ( 4, '%sB/s'%helpers_format.kmg(self.done_bytes / elapsed),                None ) )
+            parts.append(     ( 7, '%d failed'%self.failed,                                               sc.red if self.failed > 0 else None ) )
+            eta = self.eta_sec()
+            if eta is not None:
+                parts.append( ( 8, 'ETA %s%s'%(nicetime(eta), more),     sc.green ) )
+            parts.append(     ( 1, 'in %s'%helpers_format.min_sec(elapsed, 0),                        None ) )
+
+        if width is not None:
+            while len(parts) > 1 and len( ',  '.join(text for _, text, _ in parts) ) > width:
+                parts.remove( min(parts, key=lambda part: part[0]) )
+        return ',  '.join( (color(text) if color is not None else text)   for _, text, color in parts )
+
+    def show(self, force=False):
+        ''' update the display, if it's been long enough (or force) '''
+        with self.lock:
+            now = time.time()
+            if not force and now - self.shown < self.interval:
+                return
+            self.shown = now
+            if self.tty:
+                self.stream.write( '\r' + sc.ERASELINE + self.line(width=self.cols-1) )
+                self.onscreen = True
+            else:
+                self.stream.write( self.line() + '\n' )
+            self.stream.flush()
+
+    def message(self, s):
+        ''' print a line of your own, without mangling (or getting mangled by) the in-place status line '''
+        with self.lock:
+            if self.onscreen:
+                self.stream.write( '\r' + sc.ERASELINE )
+                self.onscreen = False
+            self.stream.write( s + '\n' )
+            self.stream.flush()
+            if self.tty:
+                self.shown = 0. # redraw on the next update
+
+    def finish(self):
+        ' show the final state, and end the line '
+        with self.lock:
+            self.show(force=True)
+            if self.onscreen:
+                self.stream.write('\n')
+                self.onscreen = False
+            self.stream.flush()